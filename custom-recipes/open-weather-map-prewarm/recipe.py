@@ -0,0 +1,107 @@
+from dataiku.customrecipe import (get_input_names_for_role, get_output_names_for_role,
+                                  get_plugin_config, get_recipe_config)
+from dataiku import Dataset
+from openweathermap_utils import OpenWeatherMapAPI, CacheHandler
+from openweathermap_utils.enrichment import get_lookups, load_snapper
+from openweathermap_utils.prewarm import get_prewarm_calls, prewarm_cache
+import openweathermap_utils.utils as utils
+import json
+import logging
+import constants
+
+logger = logging.getLogger(__name__)
+
+
+def load_cache_config(config):
+    plugin_config = get_plugin_config()
+
+    config.cache_location = utils.get_cache_location_from_configs(
+        cache_location=plugin_config.get("cache_location"),
+        default=plugin_config.get("cache_location_custom", "")
+    )
+    if not config.cache_location:
+        raise ValueError("The cache is not allowed in the plugin settings, there is nothing to prewarm.")
+
+    config.cache_size = plugin_config.get("cache_size", 1000) * 1000
+    config.cache_policy = plugin_config.get("cache_policy", "least-recently-stored")
+    config.cache_compression = plugin_config.get("cache_compression", True)
+    config.cache_compact = plugin_config.get("cache_compact", False)
+    config.forecast_cache_ttl = plugin_config.get("forecast_cache_ttl", 30) * 60
+    config.error_cache_ttl = plugin_config.get("error_cache_ttl", 10) * 60
+    config.cache_key_precision = plugin_config.get("cache_key_precision", 4)
+
+
+def load_recipe_config(config):
+    recipe_config = get_recipe_config()
+    preset_config = recipe_config.get("preset_config")
+
+    config.api_key = preset_config.get("api_key")
+    if not config.api_key:
+        raise ValueError("An OpenWeatherMap API key in mandatory to use the plugin. Please set one in a preset.")
+    config.api_params = utils.get_api_params_from_configs(preset_config)
+
+    config.latitude_column_name = recipe_config.get("latitude_column")
+    config.longitude_column_name = recipe_config.get("longitude_column")
+    config.date_mode = "custom"
+    config.date_column_name = recipe_config.get("date_column")
+
+    config.units = preset_config.get("units") if recipe_config.get("units") == "default" else recipe_config.get("units")
+    config.lang = preset_config.get("lang") if recipe_config.get("lang") == "default" else recipe_config.get("lang")
+
+    config.chunk_size = recipe_config.get("chunk_size") or constants.DEFAULT_CHUNK_SIZE
+
+    config.spatial_mode = recipe_config.get("spatial_mode", "none")
+    config.spatial_resolution = recipe_config.get("spatial_resolution") or 1
+    config.reference_latitude_column_name = recipe_config.get("reference_latitude_column")
+    config.reference_longitude_column_name = recipe_config.get("reference_longitude_column")
+
+
+def load_input_output(config):
+    if not get_input_names_for_role("input_dataset"):
+        raise ValueError("No input dataset.")
+    config.input_dataset = Dataset(get_input_names_for_role("input_dataset")[0])
+    config.report_dataset = Dataset(get_output_names_for_role("report_dataset")[0])
+
+    reference_dataset_names = get_input_names_for_role("reference_points")
+    config.reference_dataset = Dataset(reference_dataset_names[0]) if reference_dataset_names else None
+
+
+@utils.log_func(txt="config retrieval")
+def load_config():
+    config = utils.AttributeDict()
+
+    load_cache_config(config)
+    load_input_output(config)
+    load_recipe_config(config)
+    load_snapper(config)
+
+    return config
+
+
+@utils.log_func(txt="OpenWeatherMap cache prewarm")
+def run():
+    config = load_config()
+
+    with CacheHandler(config.cache_location, size_limit=config.cache_size, eviction_policy=config.cache_policy,
+                      compress=config.cache_compression, compact=config.cache_compact) as cache:
+        openWeatherMapAPI = OpenWeatherMapAPI(config.api_key, cache, forecast_cache_ttl=config.forecast_cache_ttl,
+                                              error_cache_ttl=config.error_cache_ttl,
+                                              cache_key_precision=config.cache_key_precision, **config.api_params)
+
+        # Distinct responses of the whole dataset, read by chunks. Rows are snapped like in the enrichment, incomplete
+        # lookups being skipped afterwards, so that a learning snapper sees the same rows.
+        calls = {}
+        columns = [config.latitude_column_name, config.longitude_column_name, config.date_column_name]
+        for input_df in config.input_dataset.iter_dataframes(chunksize=config.chunk_size, columns=columns):
+            chunk_calls = get_prewarm_calls(
+                openWeatherMapAPI, *get_lookups(input_df, config), units=config.units, lang=config.lang)
+            for cache_key, call in chunk_calls.items():
+                calls.setdefault(cache_key, call)
+
+        report_df = prewarm_cache(openWeatherMapAPI, calls, units=config.units, lang=config.lang)
+        config.report_dataset.write_with_schema(report_df)
+        utils.info_msg(f"Prewarm report: {report_df['status'].value_counts().to_dict()}")
+        utils.info_msg("Run metrics:\n{}".format(json.dumps(openWeatherMapAPI.get_run_metrics(), indent=2)))
+
+
+run()
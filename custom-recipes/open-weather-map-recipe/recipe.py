@@ -1,12 +1,16 @@
 from dataiku.customrecipe import (get_input_names_for_role, get_output_names_for_role,
                                   get_plugin_config, get_recipe_config)
-from dataiku import Dataset
+from dataiku import Dataset, Folder
 from openweathermap_utils import OpenWeatherMapAPI, CacheHandler
+from openweathermap_utils.enrichment import (build_output_df, write_output_by_chunks, append_output_df, load_snapper,
+                                             get_row_keys)
 import openweathermap_utils.utils as utils
-from datetime import datetime
-import pandas as pd
+import json
+import logging
 import constants
 
+logger = logging.getLogger(__name__)
+
 
 def load_cache_config(config):
     plugin_config = get_plugin_config()
@@ -19,6 +23,13 @@ def load_cache_config(config):
 
     config.cache_size = plugin_config.get("cache_size", 1000) * 1000
     config.cache_policy = plugin_config.get("cache_policy", "least-recently-stored")
+    config.cache_compression = plugin_config.get("cache_compression", True)
+    config.cache_compact = plugin_config.get("cache_compact", False)
+    config.memory_cache_entries = plugin_config.get("memory_cache_entries", 1000)
+    config.memory_cache_size = plugin_config.get("memory_cache_size", 100) * 1000 * 1000
+    config.forecast_cache_ttl = plugin_config.get("forecast_cache_ttl", 30) * 60
+    config.error_cache_ttl = plugin_config.get("error_cache_ttl", 10) * 60
+    config.cache_key_precision = plugin_config.get("cache_key_precision", 4)
     config.cache_enabled = recipe_config.get("cache_enabled") and config.cache_location
 
 
@@ -31,13 +42,29 @@ def load_recipe_config(config):
 
     config.date_mode = recipe_config.get("date_mode")
     if config.date_mode == "current":
-        config.date = datetime.now()
+        config.date = utils.utc_now()
     config.date_column_name = recipe_config.get("date_column", None)
+    config.historical_granularity = recipe_config.get("historical_granularity", "daily")
 
     config.units = preset_config.get("units") if recipe_config.get("units") == "default" else recipe_config.get("units")
     config.lang = preset_config.get("lang") if recipe_config.get("lang") == "default" else recipe_config.get("lang")
 
     config.parse_output = recipe_config.get("parse_output", True)
+    config.selected_columns = recipe_config.get("selected_columns") if config.parse_output else None
+
+    config.streaming_mode = recipe_config.get("streaming_mode", False)
+    config.chunk_size = recipe_config.get("chunk_size") or constants.DEFAULT_CHUNK_SIZE
+
+    config.spatial_mode = recipe_config.get("spatial_mode", "none")
+    config.spatial_resolution = recipe_config.get("spatial_resolution") or 1
+    config.reference_latitude_column_name = recipe_config.get("reference_latitude_column")
+    config.reference_longitude_column_name = recipe_config.get("reference_longitude_column")
+
+    config.incremental_mode = recipe_config.get("incremental_mode", False)
+    config.incremental_key_columns = recipe_config.get("incremental_key_columns") or [
+        column for column in [config.latitude_column_name, config.longitude_column_name, config.date_column_name]
+        if column and (column != config.date_column_name or config.date_mode == "custom")
+    ]
 
 
 def load_api_key(config):
@@ -49,6 +76,8 @@ def load_api_key(config):
     if not config.api_key:
         raise ValueError("An OpenWeatherMap API key in mandatory to use the plugin. Please set one in a preset.")
 
+    config.api_params = utils.get_api_params_from_configs(preset_config)
+
 
 def load_input_output(config):
     if not get_input_names_for_role("input_dataset"):
@@ -56,8 +85,14 @@ def load_input_output(config):
     input_dataset_name = get_input_names_for_role("input_dataset")[0]
     config.input_dataset = Dataset(input_dataset_name)
 
-    output_dataset_name = get_output_names_for_role("output_dataset")[0]
-    config.output_dataset = Dataset(output_dataset_name)
+    config.output_dataset_name = get_output_names_for_role("output_dataset")[0]
+    config.output_dataset = Dataset(config.output_dataset_name)
+
+    reference_dataset_names = get_input_names_for_role("reference_points")
+    config.reference_dataset = Dataset(reference_dataset_names[0]) if reference_dataset_names else None
+
+    metrics_folder_names = get_output_names_for_role("metrics_folder")
+    config.metrics_folder = Folder(metrics_folder_names[0]) if metrics_folder_names else None
 
 
 @utils.log_func(txt="config retrieval")
@@ -68,49 +103,76 @@ def load_config():
     load_input_output(config)
     load_api_key(config)
     load_recipe_config(config)
+    load_snapper(config)
 
     return config
 
 
-@utils.log_func(txt="data recuperation")
-def build_output_df(open_weather_map_API, config, row_processor):
-    input_df = config.input_dataset.get_dataframe()
-    weather_df = pd.DataFrame(list(input_df.apply(
-        row_processor,
-        axis=1,
-        loc_configs=config,
-        owm_func=open_weather_map_API.get_any_dt_weather_data,
-        parse_output=config.parse_output,
-        units=config.units,
-        lang=config.lang
-    )))
-    output_df = pd.concat([input_df, weather_df], axis=1)
-    utils.make_column_names_unique(output_df)
-    utils.info_msg(f"API calls #: {open_weather_map_API.api_calls_nb}")
-    return output_df
+def load_enriched_keys(config):
+    """
+    In incremental mode, reads the keys of the rows already enriched in the output dataset. If there are some, new
+    rows are appended to the output dataset with its current columns (config.output_columns).
+    """
+    config.enriched_keys = set()
+    config.output_columns = None
+    if not config.incremental_mode:
+        return
+    try:
+        # The output dataset is not an input of the recipe, it can only be read outside of the flow
+        output_dataset = Dataset(config.output_dataset_name, ignore_flow=True)
+        output_columns = [column["name"] for column in output_dataset.read_schema()]
+        if not set(config.incremental_key_columns).issubset(output_columns):
+            logger.info("Output dataset doesn't contain the key columns, all input rows are enriched")
+            return
+        keys_df = output_dataset.get_dataframe(columns=config.incremental_key_columns)
+    except Exception as err:
+        logger.info(f"Output dataset not readable, all input rows are enriched ({err})")
+        return
+    config.enriched_keys = set(get_row_keys(keys_df, config.incremental_key_columns))
+    if config.enriched_keys:
+        config.output_columns = output_columns
+    utils.info_msg(f"{len(config.enriched_keys)} keys already enriched in the output dataset")
+
+
+def write_run_metrics(open_weather_map_API, config):
+    """
+    Logs the JSON summary of the run metrics, and writes it to the metrics folder if there is one
+    """
+    run_metrics = json.dumps(open_weather_map_API.get_run_metrics(), indent=2)
+    utils.info_msg(f"Run metrics:\n{run_metrics}")
+    if config.metrics_folder:
+        path = "run_metrics_{}.json".format(utils.utc_now().strftime("%Y%m%dT%H%M%SZ"))
+        with config.metrics_folder.get_writer(path) as writer:
+            writer.write(run_metrics.encode("utf-8"))
 
 
 @utils.log_func(txt="OpenWeatherMap recipe")
 def run():
-    def process_row(row, loc_configs, owm_func, parse_output=True, **kwargs):
-        if loc_configs.date_mode == "current":
-            dt = loc_configs.date
-        else:
-            dt = row[loc_configs.date_column_name].to_pydatetime()
-        lat, lon = row[loc_configs.latitude_column_name], row[loc_configs.longitude_column_name]
-        output = owm_func(lat, lon, dt, **kwargs)
-        return output if parse_output else {constants.UNPARSED_COL_NAME: output}
-
     config = load_config()
+    load_enriched_keys(config)
 
     # Creating a fake or real cache depending on user's choice
     with CacheHandler(config.cache_location, enabled=config.cache_enabled,
-                      size_limit=config.cache_size, eviction_policy=config.cache_policy) as cache:
-        openWeatherMapAPI = OpenWeatherMapAPI(config.api_key, cache)
-
-        output_df = build_output_df(openWeatherMapAPI, config, process_row)
-        config.output_dataset.write_with_schema(output_df)
+                      size_limit=config.cache_size, eviction_policy=config.cache_policy,
+                      compress=config.cache_compression, compact=config.cache_compact,
+                      memory_entries_limit=config.memory_cache_entries,
+                      memory_size_limit=config.memory_cache_size) as cache:
+        openWeatherMapAPI = OpenWeatherMapAPI(config.api_key, cache, forecast_cache_ttl=config.forecast_cache_ttl,
+                                              error_cache_ttl=config.error_cache_ttl,
+                                              cache_key_precision=config.cache_key_precision,
+                                              selected_columns=config.selected_columns, **config.api_params)
+
+        if config.streaming_mode:
+            write_output_by_chunks(openWeatherMapAPI, config)
+        else:
+            output_df = build_output_df(openWeatherMapAPI, config)
+            with openWeatherMapAPI.metrics.timer("write"):
+                if config.output_columns:
+                    append_output_df(config, output_df)
+                else:
+                    config.output_dataset.write_with_schema(output_df)
         utils.update_columns_descriptor(config.output_dataset, config.units, config.lang)
+        write_run_metrics(openWeatherMapAPI, config)
 
 
 run()
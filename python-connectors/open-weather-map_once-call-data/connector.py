@@ -1,6 +1,10 @@
 from dataiku.connector import Connector
+from dataiku import Dataset
+from itertools import islice
 from openweathermap_utils import OpenWeatherMapAPI, CacheHandler
-from openweathermap_utils.utils import get_cache_location_from_configs
+from openweathermap_utils.utils import (get_cache_location_from_configs, get_api_params_from_configs, parse_locations,
+                                        prefetch)
+import constants
 
 
 class OpenWeatherMapConnector(Connector):
@@ -17,13 +21,25 @@ class OpenWeatherMapConnector(Connector):
 
         self.cache_size = self.plugin_config.get("cache_size", 1000) * 1000
         self.cache_policy = str(self.plugin_config.get("cache_policy"))
+        self.cache_compression = self.plugin_config.get("cache_compression", True)
+        self.cache_compact = self.plugin_config.get("cache_compact", False)
+        self.memory_cache_entries = self.plugin_config.get("memory_cache_entries", 1000)
+        self.memory_cache_size = self.plugin_config.get("memory_cache_size", 100) * 1000 * 1000
+        self.forecast_cache_ttl = self.plugin_config.get("forecast_cache_ttl", 30) * 60
+        self.error_cache_ttl = self.plugin_config.get("error_cache_ttl", 10) * 60
+        self.cache_key_precision = self.plugin_config.get("cache_key_precision", 4)
 
         self.api_key = str(preset_config.get("api_key"))
 
         if self.api_key == "None":
             raise ValueError("An OpenWeatherMap API key in mandatory to use the plugin. Please set one in a preset.")
-        self.latitude = str(self.config.get("latitude"))
-        self.longitude = str(self.config.get("longitude"))
+        self.api_params = get_api_params_from_configs(preset_config)
+        self.locations_mode = self.config.get("locations_mode", "single")
+        if self.locations_mode == "single":
+            self.latitude = str(self.config.get("latitude"))
+            self.longitude = str(self.config.get("longitude"))
+        else:
+            self.locations = self.load_locations()
         self.granularity = str(self.config.get("granularity"))
 
         self.data_type = str(self.config.get("data_type"))
@@ -31,18 +47,89 @@ class OpenWeatherMapConnector(Connector):
         self.lang = preset_config.get("lang") if self.config.get("lang") == "default" else self.config.get("lang")
         self.cache_enabled = self.config.get("cache_enabled") and self.cache_location
         self.parse_output = self.config.get("parse_output", True)
+        self.selected_columns = self.config.get("selected_columns") if self.parse_output else None
+        self.partitioned = self.config.get("partitioned", False)
+        prefetch_depth = self.config.get("prefetch_depth")
+        self.prefetch_depth = constants.DEFAULT_PREFETCH_DEPTH if prefetch_depth is None else prefetch_depth
 
         with CacheHandler(self.cache_location, enabled=self.cache_enabled,
-                          size_limit=self.cache_size, eviction_policy=self.cache_policy) as cache:
-            self.weather_api = OpenWeatherMapAPI(self.api_key, cache)
+                          size_limit=self.cache_size, eviction_policy=self.cache_policy,
+                          compress=self.cache_compression, compact=self.cache_compact,
+                          memory_entries_limit=self.memory_cache_entries,
+                          memory_size_limit=self.memory_cache_size) as cache:
+            self.weather_api = OpenWeatherMapAPI(self.api_key, cache, forecast_cache_ttl=self.forecast_cache_ttl,
+                                                 error_cache_ttl=self.error_cache_ttl,
+                                                 cache_key_precision=self.cache_key_precision,
+                                                 selected_columns=self.selected_columns, **self.api_params)
+
+    def load_locations(self):
+        """
+        :return: List of (name, lat, lon) tuples, written in the connector settings or read from a dataset
+        """
+        if self.locations_mode == "list":
+            locations = parse_locations(self.config.get("locations", ""))
+        else:
+            name_column = self.config.get("locations_name_column")
+            latitude_column = self.config.get("locations_latitude_column")
+            longitude_column = self.config.get("locations_longitude_column")
+            locations_df = Dataset(self.config.get("locations_dataset")).get_dataframe(
+                columns=[column for column in [name_column, latitude_column, longitude_column] if column])
+            locations = [
+                (str(row[name_column]) if name_column else f"{row[latitude_column]},{row[longitude_column]}",
+                 float(row[latitude_column]), float(row[longitude_column]))
+                for _, row in locations_df.dropna(subset=[latitude_column, longitude_column]).iterrows()
+            ]
+        if not locations:
+            raise ValueError("No location to retrieve the weather of. Please set at least one location.")
+        return locations
 
     def get_read_schema(self):
         if self.parse_output:
-            return self.weather_api.retrieve_schema(self.data_type, self.granularity)
+            schema = self.weather_api.retrieve_schema(self.data_type, self.granularity)
+            if self.locations_mode != "single":
+                schema = {"columns": [{"name": "location", "type": "string"}] + schema["columns"]}
+            return schema
         return None
 
+    def get_partitioning(self):
+        if not self.partitioned:
+            return None
+        return {"dimensions": [{"name": "day", "type": "time", "params": {"period": "DAY"}}]}
+
+    def list_partitions(self, partitioning):
+        return self.weather_api.list_available_days(self.data_type, self.granularity)
+
+    def partition_exists(self, partitioning, partition_id):
+        return partition_id in self.list_partitions(partitioning)
+
     def generate_rows(self, dataset_schema=None, dataset_partitioning=None,
                       partition_id=None, records_limit=-1):
+        # Upcoming rows are retrieved in the background while DSS writes the previous ones
+        return prefetch(self.get_rows(partition_id, records_limit), self.prefetch_depth)
+
+    def get_rows(self, partition_id=None, records_limit=-1):
+        if self.locations_mode != "single":
+            return self.weather_api.get_locations_weather_data_gen(
+                locations=self.locations,
+                granularity=self.granularity,
+                data_type=self.data_type,
+                day=partition_id,
+                records_limit=records_limit,
+                parse_output=self.parse_output,
+                units=self.units,
+                lang=self.lang
+            )
+        if partition_id:
+            rows = self.weather_api.get_day_weather_data_gen(
+                lat=self.latitude,
+                lon=self.longitude,
+                granularity=self.granularity,
+                day=partition_id,
+                parse_output=self.parse_output,
+                units=self.units,
+                lang=self.lang
+            )
+            return islice(rows, records_limit) if records_limit >= 0 else rows
         return self.weather_api.get_weather_data_gen(
             lat=self.latitude,
             lon=self.longitude,
@@ -50,5 +137,6 @@ class OpenWeatherMapConnector(Connector):
             data_type=self.data_type,
             parse_output=self.parse_output,
             units=self.units,
-            lang=self.lang
+            lang=self.lang,
+            records_limit=records_limit
         )
@@ -12,6 +12,13 @@ class Granularity(Enum):
     HOURLY = "hourly"
 
 
+class DateClass(Enum):
+    HISTORICAL = "historical"
+    HOURLY_FORECAST = "hourly_forecast"
+    DAILY_FORECAST = "daily_forecast"
+    OUT_OF_RANGE = "out_of_range"
+
+
 COL_TYPES = {
     "all": {""
         "dt": "date",
@@ -144,6 +151,23 @@ CACHE_RELATIVE_DIR = ".cache/dss/plugins/open_weather_map"
 NB_DAYS_MAX_FORECAST = 7
 NB_HOURS_MAX_FORECAST = 47
 NB_DAYS_MAX_HISTORICAL = 5
+# Seconds kept between the oldest requested date and the start of the historical range of the API
+HISTORICAL_RANGE_MARGIN = 10 * 60
 LOG_SEPARATOR_CHAR = "-"
 LOG_SEPARATOR_LEN = 20
 UNPARSED_COL_NAME = "unparsed_weather"
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_BACKOFF_FACTOR = 1
+RETRY_MAX_DELAY = 60
+DEFAULT_FORECAST_CACHE_TTL = 30 * 60
+DEFAULT_ERROR_CACHE_TTL = 10 * 60
+CACHED_ERROR_STATUS_CODES = [400, 404]
+ERROR_CACHE_KEY_PREFIX = "error:"
+DEFAULT_CACHE_KEY_PRECISION = 4
+DEFAULT_CHUNK_SIZE = 10000
+WEATHER_INDEXES_CACHE_SIZE = 1000
+ONE_CALL_PARTS = ["current", "minutely", "hourly", "daily", "alerts"]
+DEFAULT_PREFETCH_DEPTH = 1000
+QUOTA_DIRECTORY = "quota"
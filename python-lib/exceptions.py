@@ -8,4 +8,8 @@ class OpenWeatherMapAPIError(HTTPError):
         super(OpenWeatherMapAPIError, self).__init__(*args, **kwargs)
 
     def __str__(self):
-        return repr(self.text)
\ No newline at end of file
+        return repr(self.text)
+
+
+class QuotaExceededError(Exception):
+    pass
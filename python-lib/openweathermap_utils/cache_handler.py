@@ -1,29 +1,212 @@
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from diskcache import Cache
+from openweathermap_utils.rate_limiter import QuotaLedger
+import constants
+
+_MISSING = object()
+COMPRESSED_PREFIX = b"zlib:"
+WEATHER_RECORD_KEYS = ["current", "hourly", "daily"]
+
+
+def _get_output_fields(columns_type):
+    fields = set()
+    for key, value in columns_type.items():
+        if isinstance(value, dict):
+            fields |= _get_output_fields(value)
+        else:
+            fields.add(key.split(".")[0])
+    return fields
+
+
+OUTPUT_FIELDS = _get_output_fields(constants.COL_TYPES) | {"weather"}
+
+
+def compact_weather_data(weather_data):
+    """
+    Keeps only the fields of a OneCall response that are output columns (constants.COL_TYPES), and its top-level
+    scalars (lat, lon, timezone...). Minutely forecasts, alerts and other fields are dropped.
+    """
+    if not isinstance(weather_data, dict):
+        return weather_data
+
+    def compact_record(record):
+        return {k: v for k, v in record.items() if k in OUTPUT_FIELDS} if isinstance(record, dict) else record
+
+    compact_data = {}
+    for key, value in weather_data.items():
+        if key in WEATHER_RECORD_KEYS:
+            compact_data[key] = [compact_record(r) for r in value] if isinstance(value, list) else compact_record(value)
+        elif not isinstance(value, (dict, list)):
+            compact_data[key] = value
+    return compact_data
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache evicting the least recently used entries once it holds more than entries_limit
+    entries or more than size_limit bytes (measured on the pickled values). A limit of 0 means no limit.
+    """
+    def __init__(self, entries_limit=0, size_limit=0):
+        self.entries_limit = entries_limit
+        self.size_limit = size_limit
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value, size, expire_time = self._entries[key]
+            if expire_time is not None and expire_time <= time.time():
+                self._pop(key)
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+            return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def set(self, key, value, expire_time=None):
+        """
+        :param expire_time: Timestamp after which the entry is expired (None for no expiry)
+        """
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) if self.size_limit else 0
+        if self.size_limit and size > self.size_limit:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, size, expire_time)
+            self.size += size
+            while (self.entries_limit and len(self._entries) > self.entries_limit) or \
+                    (self.size_limit and self.size > self.size_limit):
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
 
 
 class CacheHandler(Cache):
+    """
+    Disk cache of OneCall responses, with an optional in-memory tier in front of it. Stored values can be compacted
+    (only the fields of the output columns are kept) and compressed with zlib to fit more responses in the disk
+    budget. Uncompressed values stored by previous versions are still read.
+    """
     def __init__(self, *args, **kwargs):
-        self._enabled = kwargs.get("enabled", True)
+        self._enabled = kwargs.pop("enabled", True)
+        self.location = args[0] if args else kwargs.get("directory")
+        self.compress = kwargs.pop("compress", False)
+        self.compact = kwargs.pop("compact", False)
+        memory_entries_limit = kwargs.pop("memory_entries_limit", 0)
+        memory_size_limit = kwargs.pop("memory_size_limit", 0)
+        # In-memory tier in front of the disk, serving hot keys without a SQLite lookup nor unpickling
+        self.memory_cache = LRUCache(memory_entries_limit, memory_size_limit) \
+            if self._enabled and (memory_entries_limit or memory_size_limit) else None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._quota_ledgers = []
+        self._stats_lock = threading.Lock()
 
         if self._enabled:
             super(CacheHandler, self).__init__(*args, **kwargs)
 
-    def set(self, *args, **kwargs):
-        return super(CacheHandler, self).set(*args, **kwargs) if self._enabled else True
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def compact_value(self, value):
+        """
+        :return: The value as it is read back from the cache, compacted if the compact option is set
+        """
+        return compact_weather_data(value) if self._enabled and self.compact else value
+
+    def set(self, key, value, expire=None, **kwargs):
+        if not self._enabled:
+            return True
+        value = self.compact_value(value)
+        if self.memory_cache is not None:
+            self.memory_cache.set(key, value, time.time() + expire if expire else None)
+        if self.compress:
+            value = COMPRESSED_PREFIX + zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        return super(CacheHandler, self).set(key, value, expire=expire, **kwargs)
 
     __setitem__ = set
 
-    def __exit__(self, *args):
+    def open_quota_ledger(self, api_key, calls_per_minute=0, calls_per_day=0, mode="throttle"):
+        """
+        Opens the ledger of the API calls shared by the processes using the cache location, closed with the cache
+        :return: The QuotaLedger, None without cache location
+        """
+        if not self.location:
+            return None
+        quota_ledger = QuotaLedger(
+            os.path.join(self.location, constants.QUOTA_DIRECTORY), api_key, calls_per_minute, calls_per_day, mode)
+        self._quota_ledgers.append(quota_ledger)
+        return quota_ledger
+
+    def close(self):
+        for quota_ledger in self._quota_ledgers:
+            quota_ledger.close()
         if self._enabled:
-            super(CacheHandler, self).__exit__(*args)
+            super(CacheHandler, self).close()
+
+    def __exit__(self, *args):
+        self.close()
 
     def __contains__(self, key):
-        return super(CacheHandler, self).__contains__(key) if self._enabled else False
+        if not self._enabled:
+            return False
+        if self.memory_cache is not None and key in self.memory_cache:
+            return True
+        return super(CacheHandler, self).__contains__(key)
 
     def __getitem__(self, key):
-        if self._enabled:
-            return super(CacheHandler, self).__getitem__(key)
-        raise KeyError(key)
+        return self._lookup(key, count_stats=True)
+
+    def peek(self, key):
+        """
+        Same as cache[key], without counting the lookup in the stats
+        """
+        return self._lookup(key, count_stats=False)
+
+    def _lookup(self, key, count_stats):
+        if not self._enabled:
+            raise KeyError(key)
+        if self.memory_cache is not None:
+            try:
+                value = self.memory_cache[key]
+                if count_stats:
+                    self._count("memory_hits")
+                return value
+            except KeyError:
+                pass
+        value, expire_time = super(CacheHandler, self).get(key, default=_MISSING, expire_time=True)
+        if value is _MISSING:
+            if count_stats:
+                self._count("misses")
+            raise KeyError(key)
+        if count_stats:
+            self._count("disk_hits")
+        if isinstance(value, bytes) and value.startswith(COMPRESSED_PREFIX):
+            value = pickle.loads(zlib.decompress(value[len(COMPRESSED_PREFIX):]))
+        if self.memory_cache is not None:
+            self.memory_cache.set(key, value, expire_time)
+        return value
 
     def __enter__(self):
         return super(CacheHandler, self).__enter__() if self._enabled else self
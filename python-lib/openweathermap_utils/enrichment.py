@@ -0,0 +1,141 @@
+import logging
+from itertools import chain
+import pandas as pd
+import openweathermap_utils.utils as utils
+from openweathermap_utils.spatial import get_snapper
+from constants import DataType, Granularity
+import constants
+
+logger = logging.getLogger(__name__)
+
+
+def get_row_keys(df, key_columns):
+    """
+    :return: Iterator over the keys of the rows as tuples, missing values being None so that equal keys match
+    """
+    keys_df = df[key_columns].astype(object)
+    return keys_df.where(keys_df.notna(), None).itertuples(index=False, name=None)
+
+
+def drop_enriched_rows(input_df, config):
+    """
+    Drops the input rows whose key is already in the output dataset
+    """
+    if not config.enriched_keys:
+        return input_df
+    is_new = [key not in config.enriched_keys for key in get_row_keys(input_df, config.incremental_key_columns)]
+    return input_df[is_new]
+
+
+def load_snapper(config):
+    """
+    Sets config.snapper, snapping the coordinates of the lookups according to config.spatial_mode. In "nearest"
+    mode, known points are read from config.reference_dataset if there is one.
+    """
+    known_points = None
+    if config.spatial_mode == "nearest" and config.reference_dataset:
+        columns = [config.reference_latitude_column_name, config.reference_longitude_column_name]
+        reference_df = config.reference_dataset.get_dataframe(columns=columns)
+        reference_df = reference_df.apply(pd.to_numeric, errors="coerce").dropna()
+        known_points = list(zip(reference_df[columns[0]].astype(float), reference_df[columns[1]].astype(float)))
+        utils.info_msg(f"{len(known_points)} reference points")
+    config.snapper = get_snapper(config.spatial_mode, config.spatial_resolution, known_points)
+
+
+def get_lookups(input_df, config):
+    """
+    Builds the lookups of the input rows, with snapped coordinates if there is a config.snapper
+    :return: Latitudes, longitudes and dates of the rows
+    """
+    if config.date_mode == "current":
+        dates = pd.Series(config.date, index=input_df.index)
+    else:
+        dates = input_df[config.date_column_name]
+    lats, lons = input_df[config.latitude_column_name], input_df[config.longitude_column_name]
+    if config.get("snapper") is not None:
+        lats, lons = config.snapper.snap(lats, lons)
+    return lats, lons, dates
+
+
+def enrich_df(open_weather_map_API, config, input_df):
+    """
+    Adds the weather data columns to input_df
+    """
+    weather_df = open_weather_map_API.get_any_dt_weather_data_batch(
+        *get_lookups(input_df, config),
+        historical_granularity=config.get("historical_granularity", Granularity.DAILY.value),
+        units=config.units,
+        lang=config.lang
+    )
+    if not config.parse_output:
+        weather_df = pd.DataFrame({constants.UNPARSED_COL_NAME: [
+            {k: v for k, v in output.items() if pd.notna(v)} for output in weather_df.to_dict("records")
+        ]})
+    weather_df.index = input_df.index
+    output_df = pd.concat([input_df, weather_df], axis=1)
+    utils.make_column_names_unique(output_df)
+    return output_df
+
+
+def get_output_columns(open_weather_map_API, config, output_df):
+    """
+    Columns of the output dataset when it is written by chunks: the ones of the first chunk, completed with
+    every weather column that later chunks may contain
+    """
+    columns = list(output_df.columns)
+    if config.parse_output:
+        for granularity in Granularity:
+            schema = open_weather_map_API.retrieve_schema(DataType.ALL.value, granularity.value)
+            columns += [column["name"] for column in schema["columns"] if column["name"] not in columns]
+    return columns
+
+
+@utils.log_func(txt="data recuperation")
+def build_output_df(open_weather_map_API, config):
+    input_df = drop_enriched_rows(config.input_dataset.get_dataframe(), config)
+    output_df = enrich_df(open_weather_map_API, config, input_df)
+    utils.info_msg(f"API calls #: {open_weather_map_API.api_calls_nb}")
+    return output_df
+
+
+@utils.log_func(txt="data recuperation by chunks")
+def write_output_by_chunks(open_weather_map_API, config):
+    """
+    Reads, enriches and writes the input dataset chunk by chunk so that memory usage is bounded by the chunk size.
+    The output schema is set from the first chunk, unless rows are appended to an existing output.
+    """
+    output_dfs = (
+        enrich_df(open_weather_map_API, config, drop_enriched_rows(input_df, config))
+        for input_df in config.input_dataset.iter_dataframes(chunksize=config.chunk_size)
+    )
+    first_output_df = next(output_dfs, None)
+    if config.output_columns:
+        columns = config.output_columns
+        config.output_dataset.spec_item["appendMode"] = True
+    elif first_output_df is None:
+        config.output_dataset.write_schema(config.input_dataset.read_schema())
+        return
+    else:
+        columns = get_output_columns(open_weather_map_API, config, first_output_df)
+        config.output_dataset.write_schema_from_dataframe(first_output_df.reindex(columns=columns))
+    rows_nb = 0
+    with config.output_dataset.get_writer() as writer:
+        for output_df in chain([first_output_df] if first_output_df is not None else [], output_dfs):
+            dropped_columns = set(output_df.columns) - set(columns)
+            if dropped_columns:
+                logger.warning(f"Columns missing from the output schema are dropped: {sorted(dropped_columns)}")
+            with open_weather_map_API.metrics.timer("write"):
+                writer.write_dataframe(output_df.reindex(columns=columns))
+            rows_nb += len(output_df)
+            logger.info(f"{rows_nb} rows written")
+    utils.info_msg(f"API calls #: {open_weather_map_API.api_calls_nb}")
+
+
+def append_output_df(config, output_df):
+    """
+    Appends output_df to the output dataset, keeping its current schema
+    """
+    config.output_dataset.spec_item["appendMode"] = True
+    with config.output_dataset.get_writer() as writer:
+        writer.write_dataframe(output_df.reindex(columns=config.output_columns))
+    utils.info_msg(f"{len(output_df)} new rows appended")
@@ -0,0 +1,85 @@
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile
+    :param sorted_values: Values sorted in ascending order
+    :param percent: Percentile to compute, between 0 and 100
+    :return: The percentile, None if there are no values
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(percent / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class RunMetrics:
+    """
+    Thread-safe collector of the metrics of a run: HTTP requests with their latency and status code, retries,
+    and wall-clock time spent in each phase (fetch, format, write...)
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.errors_by_status = Counter()
+        self.latencies = []
+        self.timings = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def record_request(self, latency, status_code):
+        """
+        :param latency: Duration of the request in seconds
+        :param status_code: HTTP status code of the response, or the name of the exception raised by the request
+        """
+        with self._lock:
+            self.counters["http_requests"] += 1
+            self.latencies.append(latency)
+            if status_code != 200:
+                self.errors_by_status[str(status_code)] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.timings[phase] += duration
+
+    def summary(self, cache_stats=None):
+        """
+        :param cache_stats: Hit and miss counts of the cache tiers (CacheHandler.stats)
+        :return: JSON-serializable dict of the metrics
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            summary = {
+                "http": {
+                    "requests": self.counters["http_requests"],
+                    "retries": self.counters["retries"],
+                    "errors_by_status": dict(self.errors_by_status),
+                    "cached_errors": self.counters["cached_errors"],
+                    "latency_ms": {
+                        f"p{percent}": round(percentile(latencies, percent) * 1000, 1) if latencies else None
+                        for percent in LATENCY_PERCENTILES
+                    }
+                },
+                "timings_s": {phase: round(duration, 3) for phase, duration in self.timings.items()}
+            }
+        summary["http"]["latency_ms"]["max"] = round(latencies[-1] * 1000, 1) if latencies else None
+        if cache_stats is not None:
+            lookups_nb = sum(cache_stats.values())
+            hits_nb = lookups_nb - cache_stats.get("misses", 0)
+            summary["cache"] = dict(cache_stats, hit_rate=round(hits_nb / lookups_nb, 3) if lookups_nb else None)
+        return summary
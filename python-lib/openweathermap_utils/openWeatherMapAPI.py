@@ -1,36 +1,141 @@
 import requests
 import logging
-from itertools import chain
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain, islice
+import math
+import numpy as np
 import os
+import pandas as pd
 import openweathermap_utils.utils as utils
-from datetime import datetime, timedelta
+from openweathermap_utils.cache_handler import LRUCache
+from openweathermap_utils.metrics import RunMetrics
+from openweathermap_utils.rate_limiter import TokenBucket
+from openweathermap_utils.record_plan import get_available_columns, get_columns_type, get_record_plan
+from datetime import datetime, timedelta, timezone
 from exceptions import OpenWeatherMapAPIError
-from constants import DataType, Granularity
+from constants import DataType, DateClass, Granularity
 import constants
 
 logger = logging.getLogger(__name__)
 
 
 class OpenWeatherMapAPI:
-    def __init__(self, api_key, cache):
+    def __init__(self, api_key, cache, max_workers=1, calls_per_minute=0, timeout=constants.DEFAULT_TIMEOUT,
+                 max_retries=constants.DEFAULT_MAX_RETRIES, forecast_cache_ttl=constants.DEFAULT_FORECAST_CACHE_TTL,
+                 cache_key_precision=constants.DEFAULT_CACHE_KEY_PRECISION, selected_columns=None,
+                 error_cache_ttl=constants.DEFAULT_ERROR_CACHE_TTL,
+                 quota_calls_per_minute=0, quota_calls_per_day=0, quota_mode="throttle"):
         self.api_key = api_key
         self.api_version = "2.5"
         self.base_url = f"https://api.openweathermap.org/data/{self.api_version}/"
         self.datetime_schema = "%Y-%m-%d"
         self.available_columns = constants.COL_TYPES
         self.cache = cache
+        self.forecast_cache_ttl = forecast_cache_ttl
+        self.error_cache_ttl = error_cache_ttl
+        self.cache_key_precision = cache_key_precision
+        self.selected_columns = self._check_selected_columns(selected_columns)
         self.api_calls_nb = 0
+        self.metrics = RunMetrics()
+        self.max_workers = max(1, int(max_workers))
+        self.rate_limiter = TokenBucket(calls_per_minute) if calls_per_minute else None
+        self.quota_ledger = self._build_quota_ledger(quota_calls_per_minute, quota_calls_per_day, quota_mode)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._worker_state = threading.local()
+        self._weather_indexes = LRUCache(entries_limit=constants.WEATHER_INDEXES_CACHE_SIZE)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = self._build_session()
+
+    def _check_selected_columns(self, selected_columns):
+        """
+        :param selected_columns: Weather columns to output, None or empty for all of them
+        :return: Tuple of the selected columns, None for all of them
+        """
+        if not selected_columns:
+            return None
+        unknown_columns = [column for column in selected_columns if column not in get_available_columns()]
+        if unknown_columns:
+            raise ValueError(f"Unknown weather columns: {unknown_columns}. Available: {get_available_columns()}")
+        return tuple(selected_columns)
+
+    def _build_quota_ledger(self, calls_per_minute, calls_per_day, mode):
+        """
+        Opens the ledger of the API calls shared by the plugin processes, stored in the cache directory and closed
+        with the cache
+        :return: The QuotaLedger, None if there is no quota
+        """
+        if not (calls_per_minute or calls_per_day):
+            return None
+        quota_ledger = self.cache.open_quota_ledger(self.api_key, calls_per_minute, calls_per_day, mode)
+        if quota_ledger is None:
+            logger.warning("The API quota can not be shared between jobs without a cache location, it is ignored")
+        return quota_ledger
+
+    def _build_session(self):
+        """
+        Creates a keep-alive HTTP session whose connection pool can serve every worker at once
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _get_retry_delay(self, attempt, retry_after=None):
+        """
+        Delay before retrying a request: the one required by the Retry-After header if any, else an exponential
+        backoff with jitter
+        :param attempt: Number of the attempt that just failed, starting at 0
+        :param retry_after: Value of the Retry-After header of the failed response
+        :return: Delay in seconds
+        """
+        delay = utils.parse_retry_after(retry_after)
+        if delay is None:
+            delay = constants.RETRY_BACKOFF_FACTOR * 2 ** attempt
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        return min(delay, constants.RETRY_MAX_DELAY)
 
     def _get_query(self, endpoint, params):
         """
-        Performs an HTTP GET query on the endpoint using Requests library.
+        Performs an HTTP GET query on the endpoint using the session of Requests library. Throttled requests,
+        server errors and connection errors are retried up to max_retries times.
         :param endpoint: Endpoint to query
         :param params: Querystring parameters
         :return: Response body as a dict if successful else raise an exception
         """
         params["appid"] = self.api_key
         url = os.path.join(self.base_url, endpoint)
-        r = requests.get(url, params=params)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            if self.quota_ledger:
+                self.quota_ledger.acquire()
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                self.metrics.record_request(time.perf_counter() - start, type(err).__name__)
+                if attempt == self.max_retries:
+                    raise
+                delay = self._get_retry_delay(attempt)
+                logger.info(f"Request failed ({err}), retrying in {delay:.1f}s")
+                self.metrics.incr("retries")
+                time.sleep(delay)
+                continue
+            self.metrics.record_request(time.perf_counter() - start, r.status_code)
+            if r.status_code in constants.RETRY_STATUS_CODES and attempt < self.max_retries:
+                delay = self._get_retry_delay(attempt, r.headers.get("Retry-After"))
+                logger.info(f"Error in request (status code: {r.status_code}), retrying in {delay:.1f}s")
+                self.metrics.incr("retries")
+                time.sleep(delay)
+                continue
+            break
 
         # verification of the status code
         if r.status_code != 200:
@@ -56,9 +161,88 @@ class OpenWeatherMapAPI:
         if date:
             params["dt"] = utils.datetime_to_timestamp(date)
             endpoint += "/timemachine"
-        self.api_calls_nb += 1
+        with self._lock:
+            self.api_calls_nb += 1
         return self._get_query(endpoint, dict(params, **kwargs))
 
+    def _run_in_worker(self, function, item):
+        self._worker_state.in_worker = True
+        return function(item)
+
+    def _cached_one_call(self, cache_key, lat, lon, date=None, expire=None, **kwargs):
+        """
+        Queries OneCall service unless the response is already cached
+        :param cache_key: Key of the response in the cache
+        :param expire: Seconds until the cached response expires (None for no expiry)
+        :return: Weather data of desired location for the desired date
+        """
+        # Bad requests (400, 404) are cached for error_cache_ttl seconds and raised again. Their key holds the exact
+        # requested date, as a date of the same day may be valid (e.g. out of range at noon but not in the evening).
+        error_key = constants.ERROR_CACHE_KEY_PREFIX + cache_key
+        if date:
+            error_key += ":{}".format(utils.datetime_to_timestamp(date))
+        # Concurrent lookups of the same key wait for the first one instead of querying the API too
+        with self._lock:
+            key_lock = self._key_locks.setdefault(cache_key, threading.Lock())
+        try:
+            with key_lock:
+                try:
+                    return self.cache[cache_key]
+                except KeyError:
+                    pass
+                self._raise_cached_error(error_key)
+                try:
+                    weather_data = self.cache.compact_value(self._one_call(lat, lon, date, **kwargs))
+                except requests.HTTPError as err:
+                    status_code = err.response.status_code if err.response is not None else None
+                    if self.error_cache_ttl and status_code in constants.CACHED_ERROR_STATUS_CODES:
+                        self.cache.set(error_key, (status_code, err.response.text), expire=self.error_cache_ttl)
+                    raise
+                self.cache.set(cache_key, weather_data, expire=expire)
+                return weather_data
+        finally:
+            with self._lock:
+                self._key_locks.pop(cache_key, None)
+
+    def _raise_cached_error(self, error_key):
+        """
+        Raises the error cached under error_key, if any, as an OpenWeatherMapAPIError. Cached errors are counted
+        apart from the cache stats, where the lookup of the response already counted as a miss.
+        """
+        if not self.error_cache_ttl:
+            return
+        try:
+            status_code, text = self.cache.peek(error_key)
+        except KeyError:
+            return
+        self.metrics.incr("cached_errors")
+        raise OpenWeatherMapAPIError(text, status_code=status_code, text=text)
+
+    def _imap(self, function, iterable):
+        """
+        Lazily applies function to every item of iterable, on a thread pool of max_workers threads if
+        max_workers > 1. At most max_workers items are processed ahead of the consumer and results are yielded in
+        input order. Pending items are cancelled when the consumer stops early. Calls made from a worker thread run
+        sequentially so that nested fan-outs share the same max_workers threads.
+        """
+        if self.max_workers == 1 or getattr(self._worker_state, "in_worker", False):
+            yield from map(function, iterable)
+            return
+        items = iter(iterable)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = deque(
+            executor.submit(self._run_in_worker, function, item) for item in islice(items, self.max_workers))
+        try:
+            while futures:
+                result = futures.popleft().result()
+                for item in islice(items, 1):
+                    futures.append(executor.submit(self._run_in_worker, function, item))
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
     def _format_output(self, output, lat, lon, data_type, granularity, error_msg=""):
         """
         Format the data before sending them to a dataset
@@ -70,52 +254,165 @@ class OpenWeatherMapAPI:
         :param error_msg: If there have been an error in the retrieval, write here the error message
         :return: The output formatted as wanted
         """
-        columns = self._retrieve_columns_type(data_type, granularity)
-        formatted_output = dict(
-            output,
-            output_geopoint="POINT({} {})".format(str(lon), str(lat)),
-            data_type=data_type.capitalize(),
-            granularity=granularity.capitalize(),
-            error=error_msg)
-        formatted_output = utils.flatten_dict(formatted_output)
-        formatted_output = {k: utils.cast_field(v, columns.get(k, "string")) for k, v in formatted_output.items()}
-        return formatted_output
+        return get_record_plan(data_type, granularity, self.selected_columns).format_record(
+            output, lat, lon, data_type, granularity, error_msg)
+
+    def _format_outputs(self, records):
+        """
+        Formats many records at once. Values are extracted with the record plan of both granularities, then
+        columns are cast in bulk instead of value by value.
+        :param records: List of (output, lat, lon, data_type, granularity, error_msg) tuples, as taken by
+        _format_output()
+        :return: DataFrame of formatted data, one row per record
+        """
+        plan = get_record_plan(DataType.ALL.value, selected_columns=self.selected_columns)
+        rows, extras = [], []
+        for record in records:
+            values, record_extras = plan.extract(*record)
+            rows.append(values)
+            extras.append(record_extras)
+        weather_df = pd.DataFrame(rows, columns=plan.columns, dtype=object)
+        for column, type_ in zip(plan.columns, plan.types):
+            weather_df[column] = utils.cast_column(weather_df[column], type_)
+        if any(extras):
+            extras_df = pd.DataFrame(extras, dtype=object)
+            for column in extras_df.columns:
+                weather_df[column] = utils.cast_column(extras_df[column], "string")
+        return weather_df
+
+    def _get_forecast_kwargs(self, granularity=None, **kwargs):
+        """
+        Excludes the parts of the OneCall response that forecasts of the granularity don't read, unless an exclude
+        param is given. Without granularity, current, hourly and daily forecasts are kept.
+        :return: kwargs completed with the exclude param
+        """
+        if "exclude" not in kwargs:
+            kept_parts = [granularity] if granularity else ["current"] + [g.value for g in Granularity]
+            kwargs["exclude"] = ",".join(part for part in constants.ONE_CALL_PARTS if part not in kept_parts)
+        return kwargs
+
+    def get_response_date(self, timestamp, date_class):
+        """
+        :param timestamp: UTC timestamp of the desired date
+        :param date_class: Class of the date, see utils.classify_dates()
+        :return: Date at which the historical response the weather of the desired date is read from is requested,
+        see _get_day_request_date(). None for forecasts.
+        """
+        if date_class != DateClass.HISTORICAL.value:
+            return None
+        date = utils.timestamp_to_datetime(timestamp)
+        return self._get_day_request_date(date) or date
+
+    def get_response_cache_key(self, lat, lon, date=None, granularity=None, **kwargs):
+        """
+        :param date: Requested date of a historical response, as returned by get_response_date(), None for the
+        forecast
+        :param granularity: Granularity of the forecast, None for the forecast of all granularities
+        :param kwargs: Other params of the API (units, lang...)
+        :return: Key under which fetch_response() caches the response, None if the response is not cached
+        """
+        if date is None:
+            if not self.forecast_cache_ttl:
+                return None
+            return self._get_cache_key(
+                lat=lat, lon=lon, data_type=DataType.FORECAST.value, **self._get_forecast_kwargs(granularity, **kwargs))
+        if self._get_historical_cache_expire(date) == 0:
+            return None
+        return self._get_cache_key(lat=lat, lon=lon, date=date, data_type=DataType.HISTORICAL.value, **kwargs)
+
+    def fetch_response(self, lat, lon, date=None, **kwargs):
+        """
+        Fetches a whole OneCall response, unless it is cached
+        :param date: Requested date of a historical response, as returned by get_response_date(), None for the
+        forecast
+        :param kwargs: Other params of the API (units, lang...)
+        :return: (weather_data, error) of the response, see utils.requests_error_handler()
+        """
+        if date is None:
+            return self._get_forecast_weather_data(lat, lon, **kwargs)
+        return self._get_historical_weather_data(lat, lon, date, **kwargs)
+
+    def fetch_responses(self, calls, **kwargs):
+        """
+        Lazily fetches many responses concurrently, see fetch_response() and _imap()
+        :param calls: Iterable of (lat, lon, date) tuples
+        :return: Iterator over the (weather_data, error) of the responses, in the order of calls
+        """
+        return self._imap(lambda call: self.fetch_response(*call, **kwargs), calls)
 
     @utils.requests_error_handler
     def _get_forecast_weather_data(self, lat, lon, granularity=None, **kwargs):
-        weather_data = self._one_call(lat, lon, **kwargs)
+        cache_key = self.get_response_cache_key(lat, lon, granularity=granularity, **kwargs)
+        kwargs = self._get_forecast_kwargs(granularity, **kwargs)
+        if cache_key:
+            weather_data = self._cached_one_call(cache_key, lat, lon, expire=self.forecast_cache_ttl, **kwargs)
+        else:
+            weather_data = self._one_call(lat, lon, **kwargs)
         return weather_data.get(granularity) if granularity else weather_data
 
+    def _get_historical_cache_expire(self, date):
+        """
+        Responses of past UTC days never change, while the response of the current UTC day only covers the hours
+        elapsed so far: it expires like forecasts.
+        :return: Seconds until the response of the date expires, None for no expiry, 0 to not cache it
+        """
+        if utils.datetime_to_utc_day_str(date) < utils.datetime_to_utc_day_str(utils.utc_now()):
+            return None
+        return self.forecast_cache_ttl
+
     @utils.requests_error_handler
     def _get_historical_weather_data(self, lat, lon, date, granularity=None, **kwargs):
-        cache_key = self._get_cache_key(lat=lat, lon=lon, date=date, data_type=DataType.HISTORICAL.value, **kwargs)
-        try:
-            weather_data = self.cache[cache_key]
-        except KeyError as err:
+        cache_key = self.get_response_cache_key(lat, lon, date, **kwargs)
+        if cache_key:
+            weather_data = self._cached_one_call(
+                cache_key, lat, lon, date, expire=self._get_historical_cache_expire(date), **kwargs)
+        else:
             weather_data = self._one_call(lat, lon, date, **kwargs)
-            self.cache[cache_key] = weather_data
 
         if granularity:
             return [weather_data.get("current")] if granularity == Granularity.DAILY.value \
                 else weather_data.get(Granularity.HOURLY.value)
         return weather_data
 
+    def _get_weather_index(self, weather_list, granularity, index_key=None):
+        """
+        Indexes a list of hourly or daily weather by the floored UTC timestamp of its items. Indexes are kept in
+        memory under index_key so that lookups sharing a response don't rebuild them.
+        :param weather_list: List of dicts. Each dicts represents weather for a specific day or hour
+        :param granularity: "hourly" or "daily"
+        :param index_key: Key identifying the response weather_list comes from, None to not keep the index
+        :return: Dict of floored timestamp -> weather item
+        """
+        if index_key is not None:
+            try:
+                return self._weather_indexes[index_key]
+            except KeyError:
+                pass
+        round_to = "day" if granularity == Granularity.DAILY.value else "hour"
+        index = {}
+        for weather_item in weather_list:
+            if not weather_item: break
+            index.setdefault(utils.floor_timestamp(weather_item["dt"], round_to), weather_item)
+        if index_key is not None:
+            self._weather_indexes.set(index_key, index)
+        return index
+
     @utils.requests_error_handler
-    def _find_date_in_weather_list(self, weather_list, date, granularity, data_type):
+    def _find_date_in_weather_list(self, weather_list, date, granularity, data_type, index_key=None):
         """
         From a list of dicts, find the weather as close as possible fron the desired date
         :param weather_list: List of dicts. Each dicts represents weather for a specific day or hour
         :param date: The date you want to match the weather on
         :param granularity: "hourly" or "daily"
         :param data_type: "historical"or "forecast"
+        :param index_key: Key under which the index of weather_list is kept, see _get_weather_index()
         :return: The dict corresponding to the closest date
         """
-        for weather_item in weather_list:
-            if not weather_item: break
-            dt_floorer = lambda x: utils.floor_time(x, "day" if granularity == Granularity.DAILY.value else "hour")
-            owm_dt = utils.datetime_to_timestamp(dt_floorer(utils.timestamp_to_datetime(weather_item["dt"])))
-            if owm_dt == utils.datetime_to_timestamp(dt_floorer(date)):
-                return [weather_item]
+        round_to = "day" if granularity == Granularity.DAILY.value else "hour"
+        index = self._get_weather_index(weather_list, granularity, index_key)
+        weather_item = index.get(utils.floor_timestamp(utils.datetime_to_timestamp(date), round_to))
+        if weather_item:
+            return [weather_item]
         raise OpenWeatherMapAPIError(
             status_code=400,
             text='{{"cod":"404", "message":"{} weather for date {} not found"}}'.format(
@@ -127,50 +424,205 @@ class OpenWeatherMapAPI:
         """
         Get the schema of the output dataset according to the data_type and granularity
         """
-        if data_type == "all":
-            historical_columns = dict(
-                self.available_columns[DataType.HISTORICAL.value][DataType.ALL.value],
-                **self.available_columns[DataType.HISTORICAL.value][granularity]
-            )
-            forecast_columns = dict(
-                self.available_columns[DataType.FORECAST.value][DataType.ALL.value],
-                **self.available_columns[DataType.FORECAST.value][granularity]
-            )
-            return dict(self.available_columns[DataType.ALL.value], **dict(
-                historical_columns, **forecast_columns
-            ))
-        return dict(self.available_columns[DataType.ALL.value], **dict(
-            self.available_columns[data_type][DataType.ALL.value], **self.available_columns[data_type][granularity]
-        ))
+        return get_columns_type(data_type, granularity)
 
     def _is_hourly_forecast_available(self, date):
-        return date < datetime.today() + timedelta(hours=constants.NB_HOURS_MAX_FORECAST)
+        return date < utils.utc_now() + timedelta(hours=constants.NB_HOURS_MAX_FORECAST)
+
+    def _get_oldest_historical_timestamp(self):
+        return time.time() - constants.NB_DAYS_MAX_HISTORICAL * 86400 + constants.HISTORICAL_RANGE_MARGIN
 
-    def _is_forecast_available(self, date):
-        return date < datetime.today() + timedelta(days=constants.NB_DAYS_MAX_FORECAST)
+    def _get_day_request_date(self, day):
+        """
+        Every lookup of a day reads the timemachine response requested at the same time, so that the daily weather
+        of the day doesn't depend on which lookup was fetched first
+        :param day: UTC day, as a datetime
+        :return: Date at which to request the timemachine response of the day: noon, or the oldest date in the range
+        of the API if noon is out of it, or now for the current day. None if the whole day is out of the range of
+        the API.
+        """
+        day_start = utils.floor_timestamp(utils.datetime_to_timestamp(day), "day")
+        now = time.time()
+        if now < day_start + 86400:
+            return utils.timestamp_to_datetime(now)
+        request_timestamp = max(day_start + 12 * 3600, self._get_oldest_historical_timestamp())
+        if request_timestamp >= day_start + 86400:
+            return None
+        return utils.timestamp_to_datetime(request_timestamp)
 
-    def _is_historical_available(self, date):
-        return date > datetime.today() - timedelta(days=constants.NB_DAYS_MAX_HISTORICAL)
+    def _round_coordinate(self, coordinate):
+        # Adding 0.0 turns -0.0 into 0.0
+        return round(float(coordinate), self.cache_key_precision) + 0.0
 
-    def _get_cache_key(self, **kwargs):
-        return kwargs
+    def _get_cache_key(self, lat, lon, data_type, date=None, units=None, lang=None, **kwargs):
+        """
+        Builds the canonical cache key of a OneCall response:
+        "<data_type>:<UTC day>:<lat>:<lon>:<units>:<lang>", coordinates being rounded to cache_key_precision
+        decimals. The day is empty for forecast data. Other query parameters, if any, are appended sorted.
+        """
+        key_parts = [
+            data_type,
+            utils.datetime_to_utc_day_str(date) if date else "",
+            "{:.{}f}".format(self._round_coordinate(lat), self.cache_key_precision),
+            "{:.{}f}".format(self._round_coordinate(lon), self.cache_key_precision),
+            str(units),
+            str(lang)
+        ]
+        key_parts += ["{}={}".format(k, v) for k, v in sorted(kwargs.items())]
+        return ":".join(key_parts)
 
-    def get_forecast_dt_weather_data(self, lat, lon, date, **kwargs):
-        weather_data, error = self._get_forecast_weather_data(lat, lon, **kwargs)
-        granularity = Granularity.HOURLY.value if self._is_hourly_forecast_available(date) else Granularity.DAILY.value
+    def _get_forecast_dt_record(self, lat, lon, date, granularity=None, response=None, **kwargs):
+        """
+        :param granularity: Granularity of the forecast, None for hourly if available else daily
+        :param response: (weather_data, error) of the forecast of the location if already fetched
+        :return: Arguments of _format_output() for the forecast weather of the desired date
+        """
+        weather_data, error = response or self._get_forecast_weather_data(lat, lon, **kwargs)
+        if not granularity:
+            granularity = Granularity.HOURLY.value if self._is_hourly_forecast_available(date) \
+                else Granularity.DAILY.value
+        if error.text:
+            return {}, lat, lon, DataType.FORECAST.value, granularity, error.text
+        # The index of a response is identified by its cache key and its generation time
+        index_key = (
+            self._get_cache_key(
+                lat=lat, lon=lon, data_type=DataType.FORECAST.value, **self._get_forecast_kwargs(**kwargs)),
+            granularity,
+            weather_data.get("current", {}).get("dt")
+        )
         res, error2 = self._find_date_in_weather_list(
-            weather_data.get(granularity, {}), date, granularity, DataType.FORECAST.value)
-        return self._format_output(
-            res[0], lat, lon, DataType.FORECAST.value, granularity, error.text if error.text else error2.text)
+            weather_data.get(granularity, {}), date, granularity, DataType.FORECAST.value, index_key)
+        return res[0], lat, lon, DataType.FORECAST.value, granularity, error2.text
 
-    def get_historical_dt_weather_data(self, lat, lon, date, **kwargs):
-        weather_data, error = self._get_historical_weather_data(lat, lon, date, Granularity.DAILY.value, **kwargs)
-        return self._format_output(weather_data[0], lat, lon, DataType.HISTORICAL.value, Granularity.DAILY.value, error.text)
+    def _get_historical_dt_record(self, lat, lon, date, granularity=Granularity.DAILY.value, response=None,
+                                  **kwargs):
+        """
+        :param granularity: "daily" for the weather at the desired date, "hourly" for the weather of its hour in
+        the hourly list of the timemachine response of its day
+        :param response: (weather_data, error) of the timemachine response of the day if already fetched
+        :return: Arguments of _format_output() for the historical weather of the desired date
+        """
+        weather_data, error = response or self._get_historical_weather_data(lat, lon, date, **kwargs)
+        if error.text:
+            return {}, lat, lon, DataType.HISTORICAL.value, granularity, error.text
+        if granularity == Granularity.DAILY.value:
+            return weather_data.get("current"), lat, lon, DataType.HISTORICAL.value, granularity, error.text
+        # The response of the current day is refreshed, its index is identified by its request time too
+        index_key = (
+            self._get_cache_key(lat=lat, lon=lon, date=date, data_type=DataType.HISTORICAL.value, **kwargs),
+            granularity,
+            weather_data.get("current", {}).get("dt")
+        )
+        res, error2 = self._find_date_in_weather_list(
+            weather_data.get(granularity, []), date, granularity, DataType.HISTORICAL.value, index_key)
+        return res[0], lat, lon, DataType.HISTORICAL.value, granularity, error2.text
 
-    def get_any_dt_weather_data(self, lat, lon, date, **kwargs):
-        if date < datetime.today():
-            return self.get_historical_dt_weather_data(lat, lon, date, **kwargs)
-        return self.get_forecast_dt_weather_data(lat, lon, date, **kwargs)
+    def _get_classified_dt_record(self, lat, lon, timestamp, date_class, historical_granularity=None, response=None,
+                                  **kwargs):
+        """
+        :param timestamp: UTC timestamp of the desired date
+        :param date_class: Class of the date, see utils.classify_dates()
+        :param historical_granularity: Granularity of historical data, "daily" if None
+        :param response: Response returned by fetch_response() if already fetched
+        :return: Arguments of _format_output() for the weather of the desired date
+        """
+        date = utils.timestamp_to_datetime(timestamp)
+        if date_class == DateClass.HISTORICAL.value:
+            return self._get_historical_dt_record(
+                lat, lon, date, historical_granularity or Granularity.DAILY.value, response=response, **kwargs)
+        granularity = Granularity.HOURLY.value if date_class == DateClass.HOURLY_FORECAST.value \
+            else Granularity.DAILY.value
+        return self._get_forecast_dt_record(lat, lon, date, granularity, response=response, **kwargs)
+
+    def _format_rejected_lookups(self, rejected_df, now, historical_granularity=Granularity.DAILY.value):
+        """
+        Formats the lookups rejected without querying the API, whose weather columns are all empty
+        :param rejected_df: DataFrame of the lat, lon, timestamp and rounded coordinates of the lookups
+        :param now: UTC timestamp the dates of the lookups were classified against
+        :param historical_granularity: Granularity of historical data, see utils.get_granularities()
+        :return: DataFrame of formatted data with the index of rejected_df
+        """
+        plan = get_record_plan(DataType.ALL.value, selected_columns=self.selected_columns)
+        formatted_df = pd.DataFrame(index=rejected_df.index, columns=plan.columns, dtype=object)
+        formatted_df["output_geopoint"] = \
+            "POINT(" + rejected_df["lon"].astype(str) + " " + rejected_df["lat"].astype(str) + ")"
+        formatted_df["data_type"] = np.where(
+            rejected_df["timestamp"] < now,
+            DataType.HISTORICAL.value.capitalize(),
+            DataType.FORECAST.value.capitalize()
+        )
+        formatted_df["granularity"] = [
+            granularity.capitalize()
+            for granularity in utils.get_granularities(rejected_df["timestamp"], now, historical_granularity)
+        ]
+        missing_coordinates = rejected_df[["rounded_lat", "rounded_lon"]].isna().any(axis=1)
+        formatted_df["error"] = np.select(
+            [missing_coordinates, rejected_df["timestamp"].isna()],
+            ['{"cod":"400", "message":"Missing coordinates"}', '{"cod":"400", "message":"Missing date"}'],
+            default='{{"cod":"400", "message":"Date out of range, weather data is available from {} days ago to {} '
+                    'days ahead"}}'.format(constants.NB_DAYS_MAX_HISTORICAL, constants.NB_DAYS_MAX_FORECAST)
+        )
+        for column, type_ in zip(plan.columns, plan.types):
+            formatted_df[column] = utils.cast_column(formatted_df[column], type_)
+        return formatted_df
+
+    def get_any_dt_weather_data_batch(self, lats, lons, dates, historical_granularity=Granularity.DAILY.value,
+                                      **kwargs):
+        """
+        Retrieves the weather of many lookups. Dates are classified at once against the same current time (see
+        utils.classify_dates()), then the lookups are grouped by date class, rounded coordinates and floored date:
+        daily historical and forecast data are per UTC day, hourly ones per hour. Each group is formatted only once,
+        from an API response fetched only once for all the groups reading it: the forecast of their location, or
+        the timemachine response of their location and UTC day. Lookups out of the range of the API or without
+        coordinates are rejected without querying it.
+        :param lats: Latitudes of the lookups
+        :param lons: Longitudes of the lookups
+        :param dates: Dates of the lookups, naive ones being UTC
+        :param historical_granularity: "daily" for the historical weather at the date of the lookups, "hourly" for
+        the one of their hour. Hourly lookups of the same day share the same timemachine response.
+        :param kwargs: Other params to pass to the API (units, lang...)
+        :return: DataFrame of formatted weather data, one row per lookup in the same order as the lookups
+        """
+        now = time.time()
+        lookups_df = utils.classify_dates(dates, now, historical_granularity)
+        lookups_df["lat"], lookups_df["lon"] = pd.Series(list(lats), dtype=object), pd.Series(list(lons), dtype=object)
+        for column in ["lat", "lon"]:
+            lookups_df[f"rounded_{column}"] = \
+                pd.to_numeric(lookups_df[column], errors="coerce").round(self.cache_key_precision) + 0.0
+        is_valid = (lookups_df["date_class"] != DateClass.OUT_OF_RANGE.value) & \
+            lookups_df[["rounded_lat", "rounded_lon"]].notna().all(axis=1)
+        valid_df = lookups_df[is_valid]
+        group_ids = valid_df.groupby(
+            ["date_class", "rounded_lat", "rounded_lon", "floored_timestamp"], sort=False).ngroup()
+        is_first_lookup = ~group_ids.duplicated()
+        first_lookups = valid_df.loc[is_first_lookup, ["lat", "lon", "timestamp", "date_class"]]
+        # All the forecast lookups of a location read the same response, historical ones the response of their day
+        is_forecast = valid_df["date_class"] != DateClass.HISTORICAL.value
+        response_ids = valid_df.assign(
+            response_timestamp=(valid_df["timestamp"] // 86400 * 86400).where(~is_forecast, -1)
+        ).groupby(["rounded_lat", "rounded_lon", "response_timestamp"], sort=False).ngroup()
+        first_responses = valid_df.loc[~response_ids.duplicated(), ["lat", "lon", "timestamp", "date_class"]]
+        logger.info(f"{len(first_responses)} API responses for {len(first_lookups)} distinct lookups of "
+                    f"{len(lookups_df)} rows, {(~is_valid).sum()} rejected")
+
+        with self.metrics.timer("fetch"):
+            responses = list(self.fetch_responses((
+                (lat, lon, self.get_response_date(timestamp, date_class))
+                for lat, lon, timestamp, date_class in first_responses.itertuples(index=False, name=None)
+            ), **kwargs))
+            records = [
+                self._get_classified_dt_record(
+                    *lookup, historical_granularity, response=responses[response_id], **kwargs)
+                for lookup, response_id in zip(
+                    first_lookups.itertuples(index=False, name=None), response_ids[is_first_lookup])
+            ]
+        with self.metrics.timer("format"):
+            weather_df = self._format_outputs(records).iloc[group_ids.values]
+            weather_df.index = valid_df.index
+            if not is_valid.all():
+                rejected_df = self._format_rejected_lookups(lookups_df[~is_valid], now, historical_granularity)
+                weather_df = pd.concat([weather_df, rejected_df], sort=False).sort_index()
+        return weather_df.reset_index(drop=True)
 
     def get_forecast_weather_data_gen(self, lat, lon, granularity, parse_output=True, **kwargs):
         weather_data, error = self._get_forecast_weather_data(lat, lon, granularity, **kwargs)
@@ -178,26 +630,138 @@ class OpenWeatherMapAPI:
             weather_output = self._format_output(d, lat, lon, DataType.FORECAST.value, granularity, error.text)
             yield weather_output if parse_output else {constants.UNPARSED_COL_NAME: weather_output}
 
-    def get_historical_weather_data_gen(self, lat, lon, granularity, limit_days=5, parse_output=True, **kwargs):
-        today = utils.floor_time(datetime.today(), "day").replace(hour=12)
-        days_before = 1
-        while days_before <= limit_days:
-            date = today - timedelta(days=days_before)
-            weather_data, error = self._get_historical_weather_data(lat, lon, date, granularity, **kwargs)
-            if error.status_code == 400: break
+    def get_historical_weather_data_gen(self, lat, lon, granularity, limit_days=5, parse_output=True,
+                                        records_limit=-1, **kwargs):
+        """
+        Yields the historical weather of the last limit_days days in chronological order, from the oldest day to the
+        most recent one, like the partitions of the connector. Days are fetched concurrently ahead of the consumer,
+        days out of the range of the API are skipped.
+        :param records_limit: Maximum number of rows needed (-1 for no limit), only the most recent days needed to
+        produce them are fetched
+        """
+        if records_limit is not None and records_limit >= 0:
+            rows_per_day = 1 if granularity == Granularity.DAILY.value else 24
+            limit_days = min(limit_days, math.ceil(records_limit / rows_per_day))
+        today = utils.floor_time(utils.utc_now(), "day")
+        dates = [
+            self._get_day_request_date(today - timedelta(days=days_before)) for days_before in range(limit_days, 0, -1)
+        ]
+        dates = [date for date in dates if date is not None]
+        for weather_data, error in self._imap(
+                lambda date: self._get_historical_weather_data(lat, lon, date, granularity, **kwargs), dates):
+            if error.status_code == 400: continue
             for d in weather_data:
                 weather_output = self._format_output(d, lat, lon, DataType.HISTORICAL.value, granularity, error.text)
                 yield weather_output if parse_output else {constants.UNPARSED_COL_NAME: weather_output}
-            days_before += 1
 
-    def get_weather_data_gen(self, lat, lon, granularity, data_type, **kwargs):
+    def list_available_days(self, data_type, granularity, limit_days=constants.NB_DAYS_MAX_HISTORICAL):
+        """
+        Lists the UTC days for which weather data of data_type and granularity can be retrieved. The oldest
+        historical day is left out once it is entirely out of the range of the API.
+        :return: List of days as "%Y-%m-%d" strings, in chronological order
+        """
+        today = datetime.now(timezone.utc).date()
+        oldest_day = utils.timestamp_to_datetime(self._get_oldest_historical_timestamp()).date()
+        days = []
+        if data_type in (DataType.HISTORICAL.value, DataType.ALL.value):
+            days += [
+                today - timedelta(days=days_before) for days_before in range(limit_days, 0, -1)
+                if today - timedelta(days=days_before) >= oldest_day
+            ]
+        if data_type in (DataType.FORECAST.value, DataType.ALL.value):
+            forecast_days = constants.NB_DAYS_MAX_FORECAST if granularity == Granularity.DAILY.value \
+                else math.ceil(constants.NB_HOURS_MAX_FORECAST / 24)
+            days += [today + timedelta(days=days_after) for days_after in range(forecast_days + 1)]
+        return [day.strftime(self.datetime_schema) for day in days]
+
+    def get_day_weather_data_gen(self, lat, lon, granularity, day, parse_output=True, **kwargs):
+        """
+        Yields the weather of a single UTC day: historical data for past days, forecast data from today on
+        :param day: Day as a "%Y-%m-%d" string
+        """
+        date = utils.str_to_datetime(day, self.datetime_schema).replace(hour=12, tzinfo=timezone.utc)
+        if date.date() < datetime.now(timezone.utc).date():
+            data_type = DataType.HISTORICAL.value
+            request_date = self._get_day_request_date(date)
+            if request_date is None:
+                weather_data, error = [{}], OpenWeatherMapAPIError(
+                    status_code=400,
+                    text='{{"cod":"400", "message":"Day {} out of range, historical weather data is available for '
+                         'the last {} days"}}'.format(day, constants.NB_DAYS_MAX_HISTORICAL))
+            else:
+                weather_data, error = self._get_historical_weather_data(
+                    lat, lon, request_date, granularity, **kwargs)
+        else:
+            data_type = DataType.FORECAST.value
+            weather_data, error = self._get_forecast_weather_data(lat, lon, granularity, **kwargs)
+            day_timestamp = utils.floor_timestamp(utils.datetime_to_timestamp(date), "day")
+            weather_data = [d for d in weather_data if d and utils.floor_timestamp(d["dt"], "day") == day_timestamp] \
+                if not error.text else weather_data
+        for d in weather_data:
+            weather_output = self._format_output(d, lat, lon, data_type, granularity, error.text)
+            yield weather_output if parse_output else {constants.UNPARSED_COL_NAME: weather_output}
+
+    def get_weather_data_gen(self, lat, lon, granularity, data_type, records_limit=-1, **kwargs):
+        """
+        Yields the historical then forecast weather of a location
+        :param records_limit: Maximum number of rows to yield (-1 for no limit). No API call is made once they
+        have been produced.
+        """
         gens = []
         if data_type in (DataType.HISTORICAL.value, DataType.ALL.value):
-            gens.append(self.get_historical_weather_data_gen(lat, lon, granularity, **kwargs))
+            gens.append(self.get_historical_weather_data_gen(
+                lat, lon, granularity, records_limit=records_limit, **kwargs))
         if data_type in (DataType.FORECAST.value, DataType.ALL.value):
             gens.append(self.get_forecast_weather_data_gen(lat, lon, granularity, **kwargs))
-        return chain(*gens)
+        weather_data_gen = chain.from_iterable(gens)
+        if records_limit is not None and records_limit >= 0:
+            return islice(weather_data_gen, records_limit)
+        return weather_data_gen
+
+    def get_locations_weather_data_gen(self, locations, granularity, data_type=DataType.ALL.value, day=None,
+                                       records_limit=-1, parse_output=True, **kwargs):
+        """
+        Yields the weather of many locations, location after location. Locations are fetched concurrently through
+        the same session and cache, and each row carries the name of its location in a "location" column.
+        :param locations: List of (name, lat, lon) tuples
+        :param day: If set, only the weather of this UTC day is retrieved, see get_day_weather_data_gen()
+        :param records_limit: Maximum number of rows to yield (-1 for no limit). Locations are then fetched one
+        after the other with the remaining limit, and no location is fetched once it is reached.
+        """
+        def get_location_rows(location, limit=-1):
+            name, lat, lon = location
+            if day:
+                rows = self.get_day_weather_data_gen(lat, lon, granularity, day, parse_output=parse_output, **kwargs)
+                rows = islice(rows, limit) if limit >= 0 else rows
+            else:
+                rows = self.get_weather_data_gen(
+                    lat, lon, granularity, data_type, records_limit=limit, parse_output=parse_output, **kwargs)
+            return (dict(row, location=name) for row in rows)
+
+        if records_limit is None or records_limit < 0:
+            return chain.from_iterable(
+                self._imap(lambda location: list(get_location_rows(location)), locations))
+
+        def get_limited_rows():
+            remaining = records_limit
+            for location in locations:
+                if remaining <= 0:
+                    return
+                for row in get_location_rows(location, remaining):
+                    remaining -= 1
+                    yield row
+
+        return get_limited_rows()
+
+    def get_run_metrics(self):
+        """
+        :return: JSON-serializable summary of the API calls, HTTP requests, cache lookups and phase timings so far
+        """
+        summary = self.metrics.summary(cache_stats=self.cache.stats)
+        summary["api_calls"] = self.api_calls_nb
+        if self.quota_ledger:
+            summary["quota"] = self.quota_ledger.get_usage()
+        return summary
 
     def retrieve_schema(self, data_type, granularity):
-        return {
-            "columns": [{"name": k, "type": v} for k, v in self._retrieve_columns_type(data_type, granularity).items()]}
+        return get_record_plan(data_type, granularity, self.selected_columns).get_schema()
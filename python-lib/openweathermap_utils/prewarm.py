@@ -0,0 +1,64 @@
+import logging
+import time
+import pandas as pd
+import openweathermap_utils.utils as utils
+from constants import DateClass
+
+logger = logging.getLogger(__name__)
+
+REPORT_COLUMNS = ["cache_key", "latitude", "longitude", "date", "status", "error"]
+
+
+def get_prewarm_calls(open_weather_map_API, lats, lons, dates, **kwargs):
+    """
+    Lists the OneCall responses that enriching the lookups needs, under the cache keys the enrichment reads:
+    one timemachine response per location and UTC day for historical dates, and one forecast response per location
+    for future dates. Responses that are not cached (forecasts and the current UTC day if forecasts are not cached)
+    and dates out of the range of the API are skipped.
+    :param lats: Latitudes of the lookups
+    :param lons: Longitudes of the lookups
+    :param dates: Dates of the lookups, naive ones being UTC
+    :param kwargs: Other params to pass to the API (units, lang...)
+    :return: Dict of cache key -> (lat, lon, date) of the call, date being None for forecasts
+    """
+    lookups_df = utils.classify_dates(dates, time.time())
+    lookups_df["lat"], lookups_df["lon"] = list(lats), list(lons)
+    # Lookups without date or coordinates are rejected by the enrichment without querying the API
+    has_coordinates = lookups_df[["lat", "lon"]].apply(pd.to_numeric, errors="coerce").notna().all(axis=1)
+    lookups_df = lookups_df[(lookups_df["date_class"] != DateClass.OUT_OF_RANGE.value) & has_coordinates]
+    # Lookups of the same location and day read at most the same responses
+    lookups_df = lookups_df.assign(day=lookups_df["timestamp"] // 86400).drop_duplicates(
+        subset=["lat", "lon", "date_class", "day"])
+    calls = {}
+    for lat, lon, timestamp, date_class in lookups_df[["lat", "lon", "timestamp", "date_class"]].itertuples(
+            index=False, name=None):
+        date = open_weather_map_API.get_response_date(timestamp, date_class)
+        cache_key = open_weather_map_API.get_response_cache_key(lat, lon, date, **kwargs)
+        if cache_key:
+            calls.setdefault(cache_key, (lat, lon, date))
+    return calls
+
+
+def prewarm_cache(open_weather_map_API, calls, **kwargs):
+    """
+    Fills the cache with the responses of calls, concurrently. Responses already cached are skipped, so that an
+    interrupted prewarm resumes where it stopped.
+    :param calls: Dict of cache key -> (lat, lon, date), as returned by get_prewarm_calls()
+    :param kwargs: Other params to pass to the API (units, lang...), the same as in get_prewarm_calls()
+    :return: DataFrame reporting the status of each call: "cached" (skipped), "fetched" or "error"
+    """
+    if not open_weather_map_API.cache.enabled:
+        raise ValueError("The cache must be enabled to be prewarmed. Please allow it in the plugin settings.")
+
+    cached_keys = set(cache_key for cache_key in calls if cache_key in open_weather_map_API.cache)
+    missing_keys = [cache_key for cache_key in calls if cache_key not in cached_keys]
+    logger.info(f"{len(calls)} responses to prewarm, {len(cached_keys)} already cached")
+
+    report = [(cache_key, *calls[cache_key], "cached", "") for cache_key in cached_keys]
+    responses = open_weather_map_API.fetch_responses((calls[cache_key] for cache_key in missing_keys), **kwargs)
+    for fetched_nb, (cache_key, (_, error)) in enumerate(zip(missing_keys, responses), start=1):
+        status = "fetched" if error.status_code == 200 else "error"
+        report.append((cache_key, *calls[cache_key], status, error.text))
+        if fetched_nb % 100 == 0:
+            logger.info(f"{fetched_nb}/{len(missing_keys)} responses fetched")
+    return pd.DataFrame(report, columns=REPORT_COLUMNS)
@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from diskcache import Cache
+from exceptions import QuotaExceededError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to cap the rate of API calls. Tokens are refilled continuously at
+    calls_per_minute / 60 per second, up to capacity. acquire() blocks until a token is available.
+    """
+    def __init__(self, calls_per_minute, capacity=1):
+        if calls_per_minute <= 0:
+            raise ValueError("The rate limit must be a positive number of calls per minute.")
+        self.rate = calls_per_minute / 60.0
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class QuotaLedger:
+    """
+    Counts the API calls made with an API key in a disk cache, so that every plugin process sharing the cache
+    directory draws from the same per-minute and daily budgets. Calls are counted in fixed windows: the current
+    minute and the current UTC day. When the per-minute budget is spent, acquire() waits for the next minute in
+    "throttle" mode or raises in "fail" mode. A spent daily budget always raises.
+    """
+    def __init__(self, directory, api_key, calls_per_minute=0, calls_per_day=0, mode="throttle"):
+        self.calls_per_minute = calls_per_minute
+        self.calls_per_day = calls_per_day
+        self.mode = mode
+        # Counters are keyed by a hash of the API key so that the key is not written on disk
+        self.key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        self._cache = Cache(directory)
+
+    def _get_keys(self, now):
+        minute = int(now // 60)
+        day = datetime.fromtimestamp(now, tz=timezone.utc).strftime("%Y-%m-%d")
+        return f"minute:{self.key_id}:{minute}", f"day:{self.key_id}:{day}"
+
+    def _try_acquire(self, now):
+        """
+        :return: Seconds to wait for the next minute if the per-minute budget is spent, else 0 once the call counted
+        """
+        minute_key, day_key = self._get_keys(now)
+        with self._cache.transact():
+            minute_calls = self._cache.get(minute_key, 0)
+            day_calls = self._cache.get(day_key, 0)
+            if self.calls_per_day and day_calls >= self.calls_per_day:
+                raise QuotaExceededError(
+                    f"The daily quota of {self.calls_per_day} API calls shared by the plugin jobs is spent. "
+                    "Please retry tomorrow (UTC) or raise the daily quota in the preset."
+                )
+            if self.calls_per_minute and minute_calls >= self.calls_per_minute:
+                return 60 - now % 60
+            self._cache.set(minute_key, minute_calls + 1, expire=2 * 60)
+            self._cache.set(day_key, day_calls + 1, expire=2 * 24 * 60 * 60)
+        return 0
+
+    def acquire(self):
+        while True:
+            wait_time = self._try_acquire(time.time())
+            if not wait_time:
+                return
+            if self.mode == "fail":
+                raise QuotaExceededError(
+                    f"The quota of {self.calls_per_minute} API calls per minute shared by the plugin jobs is spent. "
+                    "Please retry later, or set the preset to wait for the quota."
+                )
+            logger.info(f"Quota of API calls per minute spent by the plugin jobs, waiting {wait_time:.1f}s")
+            # Jitter so that the waiting processes do not all retry at the same time
+            time.sleep(wait_time + random.uniform(0, 1))
+
+    def get_usage(self):
+        """
+        :return: Calls counted in the current minute and UTC day by all the processes
+        """
+        minute_key, day_key = self._get_keys(time.time())
+        return {"calls_this_minute": self._cache.get(minute_key, 0), "calls_today": self._cache.get(day_key, 0)}
+
+    def close(self):
+        self._cache.close()
@@ -0,0 +1,124 @@
+from functools import lru_cache
+import openweathermap_utils.utils as utils
+from constants import DataType, Granularity
+import constants
+
+METADATA_COLUMNS = ["output_geopoint", "data_type", "granularity", "error"]
+WEATHER_CONDITION_COLUMNS = ["weather.0.id", "weather.0.main", "weather.0.description", "weather.0.icon"]
+CASTERS = {
+    "date": utils.timestamp_to_utc_str,
+    "float": float,
+    "int": int,
+    "boolean": lambda value: value in ["true", True, "T", 1, "Vrai", "V", "1", "True"],
+    "string": str
+}
+
+
+def get_columns_type(data_type, granularity=None):
+    """
+    Get the type of the output columns according to the data_type and granularity
+    :param data_type: "historical", "forecast" or "all"
+    :param granularity: "hourly", "daily", or None for both
+    :return: Ordered dict of column name -> type
+    """
+    data_types = [DataType.HISTORICAL.value, DataType.FORECAST.value] if data_type == DataType.ALL.value \
+        else [data_type]
+    granularities = [granularity] if granularity else [g.value for g in Granularity]
+    columns_type = dict(constants.COL_TYPES[DataType.ALL.value])
+    for granularity in granularities:
+        for data_type in data_types:
+            columns_type.update(constants.COL_TYPES[data_type][DataType.ALL.value])
+            columns_type.update(constants.COL_TYPES[data_type][granularity])
+    return columns_type
+
+
+def _column_path(column):
+    return tuple(int(key) if key.isdigit() else key for key in column.split("."))
+
+
+def _get_leaf(record, path):
+    for key in path:
+        try:
+            record = record[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return None if isinstance(record, (dict, list)) else record
+
+
+class RecordPlan:
+    """
+    Formatting plan of the weather records of a data type and granularity, compiled once: the ordered output
+    columns, the key path of each column in a raw record and the converter of its values. Formatting a record is
+    then a flat loop over the columns. Fields of a record that no column reads, such as rain.1h in daily data or
+    the second weather condition, are flattened as strings, unless the plan is projected on selected columns.
+    """
+    def __init__(self, columns_type, selected_columns=None):
+        data_columns = [column for column in columns_type if column not in METADATA_COLUMNS]
+        data_columns += WEATHER_CONDITION_COLUMNS
+        if selected_columns:
+            data_columns = [column for column in data_columns if column in selected_columns]
+        self.projected = bool(selected_columns)
+        self.columns = data_columns + METADATA_COLUMNS
+        self.types = [columns_type.get(column, "string") for column in self.columns]
+        self._paths = [_column_path(column) for column in data_columns]
+        self._converters = [CASTERS[type_] for type_ in self.types]
+        self._data_columns = set(data_columns)
+        self._top_keys = set(path[0] for path in self._paths)
+
+    def extract(self, output, lat, lon, data_type, granularity, error_msg=""):
+        """
+        Extracts the raw values of a record, takes the same arguments as OpenWeatherMapAPI._format_output()
+        :return: List of raw values in the order of columns, dict of the flattened extra fields
+        """
+        values = [_get_leaf(output, path) for path in self._paths]
+        values += [
+            "POINT({} {})".format(str(lon), str(lat)), data_type.capitalize(), granularity.capitalize(), error_msg]
+        extras = {}
+        if output and not self.projected:
+            # Only nested fields and unread keys can hold leaves that no column reads
+            extra_fields = {
+                key: value for key, value in output.items()
+                if key not in self._top_keys or isinstance(value, (dict, list))
+            }
+            extras = {
+                key: value for key, value in utils.flatten_dict(extra_fields).items()
+                if key not in self._data_columns
+            }
+        return values, extras
+
+    def format_record(self, *args, **kwargs):
+        """
+        Formats a record, takes the same arguments as OpenWeatherMapAPI._format_output()
+        :return: Dict of column name -> typed value
+        """
+        values, extras = self.extract(*args, **kwargs)
+        formatted_output = {
+            column: converter(value) if value else value
+            for column, converter, value in zip(self.columns, self._converters, values)
+        }
+        formatted_output.update({k: str(v) if v else v for k, v in extras.items()})
+        return formatted_output
+
+    def get_schema(self):
+        return {"columns": [{"name": column, "type": type_} for column, type_ in zip(self.columns, self.types)]}
+
+
+def get_available_columns():
+    """
+    :return: Names of the weather columns a record plan can be projected on
+    """
+    return [
+        column for column in get_columns_type(DataType.ALL.value) if column not in METADATA_COLUMNS
+    ] + WEATHER_CONDITION_COLUMNS
+
+
+@lru_cache(maxsize=None)
+def get_record_plan(data_type, granularity=None, selected_columns=None):
+    """
+    :param data_type: "historical", "forecast" or "all"
+    :param granularity: "hourly", "daily", or None for records of both granularities
+    :param selected_columns: Tuple of the weather columns to output, None for all of them. Metadata columns
+    (output_geopoint, data_type, granularity, error) are always output.
+    :return: The compiled RecordPlan, built once per (data_type, granularity, selected_columns)
+    """
+    return RecordPlan(get_columns_type(data_type, granularity), selected_columns)
@@ -0,0 +1,122 @@
+import math
+from collections import defaultdict
+from itertools import product
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+SNAPPED_COORDINATE_DECIMALS = 6
+
+
+def _to_float_array(values):
+    # Non-numeric coordinates become NaN, as in the batch, so that their lookups are rejected as missing
+    return pd.to_numeric(pd.Series(list(values), dtype=object), errors="coerce").to_numpy(dtype=float)
+
+
+class GridSnapper:
+    """
+    Snaps coordinates to the center of their cell in a grid of cells of about resolution_km by resolution_km.
+    Latitude rows are resolution_km high and each row is split in as many cells resolution_km wide as fit around
+    the Earth at the latitude of its center.
+    """
+    def __init__(self, resolution_km):
+        self.resolution_km = resolution_km
+        self.lat_step = resolution_km / KM_PER_DEGREE
+
+    def snap(self, lats, lons):
+        """
+        :param lats: Latitudes to snap
+        :param lons: Longitudes to snap
+        :return: Lists of the snapped latitudes and longitudes
+        """
+        lats = _to_float_array(lats)
+        lons = _to_float_array(lons)
+        # A coordinate without the other one is not snapped, both stay missing
+        is_missing = np.isnan(lats) | np.isnan(lons)
+        lats, lons = np.where(is_missing, np.nan, lats), np.where(is_missing, np.nan, lons)
+        lat_centers = np.clip((np.floor((lats + 90) / self.lat_step) + 0.5) * self.lat_step - 90, -90, 90)
+        row_length_km = 2 * math.pi * EARTH_RADIUS_KM * np.cos(np.radians(lat_centers))
+        lon_steps = 360 / np.maximum(1, np.floor(row_length_km / self.resolution_km))
+        lon_centers = (np.floor(((lons + 180) % 360) / lon_steps) + 0.5) * lon_steps - 180
+        return (
+            np.round(lat_centers, SNAPPED_COORDINATE_DECIMALS).tolist(),
+            np.round(lon_centers, SNAPPED_COORDINATE_DECIMALS).tolist()
+        )
+
+
+def _to_cartesian(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (
+        EARTH_RADIUS_KM * math.cos(lat) * math.cos(lon),
+        EARTH_RADIUS_KM * math.cos(lat) * math.sin(lon),
+        EARTH_RADIUS_KM * math.sin(lat)
+    )
+
+
+class NearestPointSnapper:
+    """
+    Snaps coordinates to the nearest known point within radius_km. Known points are indexed by the cell of a 3D grid
+    of radius_km cells containing their cartesian coordinates, so that a lookup only scans the 27 cells around the
+    coordinates. Without known points given, coordinates farther than radius_km from every known point become known
+    points: nearby coordinates are then clustered around the first one seen.
+    """
+    def __init__(self, radius_km, known_points=None):
+        self.radius_km = radius_km
+        self.learn = known_points is None
+        # Straight-line distance between two points radius_km apart on the surface
+        self.max_chord = 2 * EARTH_RADIUS_KM * math.sin(min(radius_km / (2 * EARTH_RADIUS_KM), math.pi / 2))
+        self._cells = defaultdict(list)
+        for lat, lon in known_points or []:
+            self._add(lat, lon, _to_cartesian(lat, lon))
+
+    def __len__(self):
+        return sum(len(points) for points in self._cells.values())
+
+    def _get_cell(self, xyz):
+        return tuple(int(math.floor(coordinate / self.radius_km)) for coordinate in xyz)
+
+    def _add(self, lat, lon, xyz):
+        self._cells[self._get_cell(xyz)].append((xyz, (lat, lon)))
+
+    def snap_point(self, lat, lon):
+        if math.isnan(lat) or math.isnan(lon):
+            return math.nan, math.nan
+        xyz = _to_cartesian(lat, lon)
+        cell = self._get_cell(xyz)
+        nearest_point, nearest_chord = None, self.max_chord
+        for offset in product((-1, 0, 1), repeat=3):
+            for point_xyz, point in self._cells.get(tuple(c + o for c, o in zip(cell, offset)), []):
+                chord = math.sqrt(sum((a - b) ** 2 for a, b in zip(xyz, point_xyz)))
+                if chord <= nearest_chord:
+                    nearest_point, nearest_chord = point, chord
+        if nearest_point is not None:
+            return nearest_point
+        if self.learn:
+            self._add(lat, lon, xyz)
+        return lat, lon
+
+    def snap(self, lats, lons):
+        """
+        :param lats: Latitudes to snap
+        :param lons: Longitudes to snap
+        :return: Lists of the snapped latitudes and longitudes
+        """
+        lats, lons = _to_float_array(lats).tolist(), _to_float_array(lons).tolist()
+        snapped_points = [self.snap_point(lat, lon) for lat, lon in zip(lats, lons)]
+        return [point[0] for point in snapped_points], [point[1] for point in snapped_points]
+
+
+def get_snapper(spatial_mode, resolution_km, known_points=None):
+    """
+    :param spatial_mode: "grid" to snap to the center of grid cells, "nearest" to snap to the nearest known point,
+    anything else to not snap
+    :param resolution_km: Size of the grid cells, or maximum snapping distance to a known point
+    :param known_points: List of (lat, lon) tuples of the known points, None to learn them from the coordinates
+    :return: The snapper, with a snap(lats, lons) method, or None
+    """
+    if spatial_mode == "grid":
+        return GridSnapper(resolution_km)
+    if spatial_mode == "nearest":
+        return NearestPointSnapper(resolution_km, known_points)
+    return None
@@ -1,14 +1,20 @@
 import logging
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import numpy as np
 import pandas as pd
 from exceptions import OpenWeatherMapAPIError
 from requests import HTTPError
 import pwd
+import queue
+import threading
 import constants
+from constants import DateClass, Granularity
 import os
 
 
 logger = logging.getLogger(__name__)
+_END_OF_ITEMS = object()
 
 
 def floor_time(dt=None, round_to="day"):
@@ -25,12 +31,100 @@ def floor_time(dt=None, round_to="day"):
     return dt.replace(**{k: 0 if rt_index + i > 1 else 1 for i, k in enumerate(datetime_els[rt_index + 1:])})
 
 
+def floor_timestamp(ts, round_to="day"):
+    """
+    Floors a timestamp to the closest previous UTC "round_to" (day, hour or minute)
+    """
+    seconds = {"day": 86400, "hour": 3600, "minute": 60}[round_to]
+    return int(ts) - int(ts) % seconds
+
+
+def utc_now():
+    """
+    :return: Current UTC date and time, as a naive datetime like the dates of the input datasets
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def datetime_to_timestamp(dt):
-    return int(dt.timestamp())
+    """
+    Naive datetimes are UTC
+    """
+    return int((dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt).timestamp())
 
 
 def timestamp_to_datetime(ts):
-    return datetime.fromtimestamp(int(ts))
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc)
+
+
+def to_utc_timestamps(dates):
+    """
+    Vectorized conversion of dates to UTC timestamps, naive dates being UTC
+    :param dates: Iterable of dates
+    :return: Float Series of timestamps in seconds, NaN for missing dates
+    """
+    dates = pd.to_datetime(pd.Series(dates).reset_index(drop=True))
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert(None)
+    return (dates - pd.Timestamp(0)) / pd.Timedelta(seconds=1)
+
+
+def classify_dates(dates, now, historical_granularity="daily"):
+    """
+    Classifies dates by the OpenWeatherMap data serving them, all against the same current time: historical data
+    up to NB_DAYS_MAX_HISTORICAL days back, hourly forecasts up to NB_HOURS_MAX_FORECAST hours ahead, then daily
+    forecasts up to NB_DAYS_MAX_FORECAST days ahead. Other dates, missing ones included, are out of range.
+    :param dates: Iterable of dates, naive ones being UTC
+    :param now: Current UTC timestamp
+    :param historical_granularity: "daily" or "hourly", granularity of the historical data
+    :return: DataFrame of the "timestamp", "date_class" (DateClass value) and "floored_timestamp" of each date,
+    floored to the day, or to the hour for hourly forecasts and hourly historical data. The floored timestamp of out
+    of range dates is NaN.
+    """
+    timestamps = to_utc_timestamps(dates)
+    date_classes = np.select(
+        [
+            (timestamps > now - constants.NB_DAYS_MAX_HISTORICAL * 86400) & (timestamps < now),
+            (timestamps >= now) & (timestamps < now + constants.NB_HOURS_MAX_FORECAST * 3600),
+            (timestamps >= now) & (timestamps < now + constants.NB_DAYS_MAX_FORECAST * 86400)
+        ],
+        [DateClass.HISTORICAL.value, DateClass.HOURLY_FORECAST.value, DateClass.DAILY_FORECAST.value],
+        default=DateClass.OUT_OF_RANGE.value
+    )
+    hourly_classes = [DateClass.HOURLY_FORECAST.value]
+    if historical_granularity == Granularity.HOURLY.value:
+        hourly_classes.append(DateClass.HISTORICAL.value)
+    seconds = np.where(np.isin(date_classes, hourly_classes), 3600, 86400)
+    floored_timestamps = (timestamps // seconds * seconds).where(date_classes != DateClass.OUT_OF_RANGE.value)
+    return pd.DataFrame({
+        "timestamp": timestamps,
+        "date_class": date_classes,
+        "floored_timestamp": floored_timestamps
+    })
+
+
+def get_granularities(timestamps, now, historical_granularity="daily"):
+    """
+    Granularity of the weather of each date, as served in classify_dates(), out of range dates included
+    :param timestamps: Series of UTC timestamps, NaN for missing dates
+    :param now: Current UTC timestamp
+    :param historical_granularity: "daily" or "hourly", granularity of the historical data
+    :return: Array of granularities: historical_granularity for past dates, "hourly" up to NB_HOURS_MAX_FORECAST
+    hours ahead, "daily" for later and missing dates
+    """
+    return np.select(
+        [timestamps < now, timestamps < now + constants.NB_HOURS_MAX_FORECAST * 3600],
+        [historical_granularity, Granularity.HOURLY.value],
+        default=Granularity.DAILY.value
+    )
+
+
+def timestamp_to_utc_str(ts):
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def datetime_to_utc_day_str(dt):
+    return datetime.fromtimestamp(datetime_to_timestamp(dt), tz=timezone.utc).strftime("%Y-%m-%d")
 
 
 def datetime_to_str(dt, formatter="%Y-%m-%d"):
@@ -102,6 +196,112 @@ def get_cache_location_from_configs(cache_location, default):
     return default
 
 
+def get_api_params_from_configs(preset_config):
+    """
+    Retrieves the OpenWeatherMapAPI concurrency and quota settings of a preset
+    :param preset_config: OpenWeatherMap preset
+    :return: Dict of keyword arguments for OpenWeatherMapAPI()
+    """
+    return {
+        "max_workers": preset_config.get("max_workers") or 1,
+        "calls_per_minute": preset_config.get("calls_per_minute") or 0,
+        "timeout": preset_config.get("timeout") or constants.DEFAULT_TIMEOUT,
+        "max_retries": preset_config.get("max_retries", constants.DEFAULT_MAX_RETRIES),
+        "quota_calls_per_minute": preset_config.get("quota_calls_per_minute") or 0,
+        "quota_calls_per_day": preset_config.get("quota_calls_per_day") or 0,
+        "quota_mode": preset_config.get("quota_mode") or "throttle"
+    }
+
+
+def parse_locations(locations_text):
+    """
+    Parses a list of locations written one per line as "latitude,longitude[,name]"
+    :param locations_text: Text to parse
+    :return: List of (name, lat, lon) tuples. A location without name is named "latitude,longitude".
+    """
+    locations = []
+    for line_number, line in enumerate(locations_text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        parts = [part.strip() for part in line.split(",", 2)]
+        try:
+            lat, lon = float(parts[0]), float(parts[1])
+        except (IndexError, ValueError):
+            raise ValueError(f"Invalid location on line {line_number}: '{line}'. Expected 'latitude,longitude[,name]'.")
+        name = parts[2] if len(parts) == 3 and parts[2] else f"{lat},{lon}"
+        locations.append((name, lat, lon))
+    return locations
+
+
+def prefetch(iterable, depth):
+    """
+    Iterates over iterable in a background thread, up to depth items ahead of the consumer, so that producing the
+    items (API calls, formatting) overlaps with consuming them. The bounded queue stops the producer when the
+    consumer lags behind. Exceptions raised while producing are raised to the consumer.
+    :param depth: Maximum number of items produced ahead of the consumer, 0 to iterate in the consumer thread
+    """
+    if not depth or depth <= 0:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((_END_OF_ITEMS, None))
+        except Exception as err:
+            put((_END_OF_ITEMS, err))
+        finally:
+            # Closing the iterator here releases its resources (e.g. thread pools) in the thread that used it
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _END_OF_ITEMS:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def parse_retry_after(retry_after):
+    """
+    Parses the value of a Retry-After header, given either in seconds or as an HTTP date
+    :param retry_after: Header value
+    :return: Number of seconds to wait, or None if the header is missing or invalid
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
 def requests_error_handler(function):
     """
     Raises an exception or ignore it according to the type of error.
@@ -141,18 +341,24 @@ def log_txt(txt):
     return output_txt
 
 
-def cast_field(value, type_):
-    if not value:
-        return value
+def cast_column(column, type_):
+    """
+    Casts a whole column of raw values to the type of the output column. Empty values are left untouched.
+    :param column: pandas Series of raw values
+    :param type_: Type of the column
+    :return: Cast Series
+    """
+    empty = column.isna() | (column == "")
     if type_ == "date":
-        return timestamp_to_datetime(value).isoformat() + "Z"
+        dates = pd.to_datetime(pd.to_numeric(column.where(~empty), errors="coerce"), unit="s", utc=True)
+        return dates.dt.strftime("%Y-%m-%dT%H:%M:%SZ").where(~empty, column)
     if type_ == "float":
-        return float(value)
+        return pd.to_numeric(column.where(~empty), errors="coerce").astype(float)
     if type_ == "int":
-        return int(value)
+        return pd.to_numeric(column.where(~empty), errors="coerce").astype("Int64")
     if type_ == "boolean":
-        return value in ["true", True, "T", 1, "Vrai", "V", "1", "True"]
-    return str(value)
+        return column.isin(["true", True, "T", 1, "Vrai", "V", "1", "True"]).where(~empty, column)
+    return column.astype(object).where(empty, column.astype(str))
 
 
 def info_msg(msg):
@@ -0,0 +1,191 @@
+"""
+Offline throughput benchmark of the plugin, run against a local stub of OpenWeatherMap API.
+
+Drives the recipe path (build_output_df) on synthetic inputs of various sizes and numbers of distinct locations,
+with a cold then a warm cache, and the connector generators on various numbers of locations. Reports rows/sec,
+API calls, cache hit rate and peak memory of each scenario.
+
+Usage (from the plugin root directory):
+    PYTHONPATH=python-lib python tests/python/benchmark/run_benchmark.py --rows 1000,10000 --locations 10,100
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "python-lib"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from openweathermap_utils import OpenWeatherMapAPI, CacheHandler  # noqa: E402
+from openweathermap_utils.enrichment import build_output_df  # noqa: E402
+import openweathermap_utils.utils as utils  # noqa: E402
+from stub_server import StubOpenWeatherMapServer  # noqa: E402
+
+
+class InMemoryDataset:
+    """
+    Input dataset of the benchmarked recipe
+    """
+    def __init__(self, df):
+        self.df = df
+
+    def get_dataframe(self):
+        return self.df.copy()
+
+    def iter_dataframes(self, chunksize=10000):
+        for start in range(0, len(self.df), chunksize):
+            yield self.df.iloc[start:start + chunksize].reset_index(drop=True)
+
+
+def build_input_df(rows_nb, locations_nb, seed=0):
+    """
+    Synthetic recipe input: rows_nb rows spread over locations_nb distinct locations and dates between 4 days
+    back and 6 days ahead
+    """
+    rng = random.Random(seed)
+    locations = [(rng.uniform(-60, 60), rng.uniform(-180, 180)) for _ in range(locations_nb)]
+    now = datetime.utcnow()
+    rows = []
+    for row_id in range(rows_nb):
+        lat, lon = rng.choice(locations)
+        rows.append({
+            "id": row_id,
+            "lat": lat,
+            "lon": lon,
+            "date": pd.Timestamp(now + timedelta(hours=rng.randint(-4 * 24, 6 * 24)))
+        })
+    return pd.DataFrame(rows)
+
+
+def build_api(stub, cache, args):
+    api = OpenWeatherMapAPI("benchmark", cache, max_workers=args.max_workers, calls_per_minute=args.calls_per_minute)
+    api.base_url = stub.base_url
+    return api
+
+
+def get_hit_rate(cache):
+    hits = cache.stats["memory_hits"] + cache.stats["disk_hits"]
+    lookups = hits + cache.stats["misses"]
+    return hits / lookups if lookups else 0.0
+
+
+def measure(stub, function):
+    """
+    Runs function and measures its duration, its peak memory and the requests received by the stub
+    :return: (result of function, metrics dict)
+    """
+    stub.reset_counters()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {
+        "duration_s": round(duration, 3),
+        "http_requests": stub.requests_nb,
+        "throttled_requests": stub.throttled_nb,
+        "peak_memory_mb": round(peak_memory / 1e6, 1)
+    }
+
+
+def run_recipe_scenario(stub, args, rows_nb, locations_nb):
+    input_df = build_input_df(rows_nb, locations_nb)
+    config = utils.AttributeDict(
+        input_dataset=InMemoryDataset(input_df),
+        latitude_column_name="lat",
+        longitude_column_name="lon",
+        date_mode="custom",
+        date_column_name="date",
+        units="metric",
+        lang="en",
+        parse_output=True,
+        enriched_keys=set()
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for cache_state in ["cold", "warm"]:
+            with CacheHandler(cache_dir, memory_entries_limit=args.memory_cache_entries) as cache:
+                api = build_api(stub, cache, args)
+                output_df, metrics = measure(stub, lambda: build_output_df(api, config))
+                results.append(dict(
+                    scenario="recipe",
+                    cache=cache_state,
+                    rows=len(output_df),
+                    locations=locations_nb,
+                    rows_per_s=round(len(output_df) / metrics["duration_s"], 1),
+                    api_calls=api.api_calls_nb,
+                    cache_hit_rate=round(get_hit_rate(cache), 3),
+                    **metrics
+                ))
+    return results
+
+
+def run_connector_scenario(stub, args, locations_nb, granularity):
+    rng = random.Random(locations_nb)
+    locations = [
+        (str(i), round(rng.uniform(-60, 60), 4), round(rng.uniform(-180, 180), 4)) for i in range(locations_nb)]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with CacheHandler(cache_dir, memory_entries_limit=args.memory_cache_entries) as cache:
+            api = build_api(stub, cache, args)
+            rows, metrics = measure(stub, lambda: sum(1 for _ in api.get_locations_weather_data_gen(
+                locations, granularity, units="metric", lang="en")))
+            return [dict(
+                scenario=f"connector ({granularity})",
+                cache="cold",
+                rows=rows,
+                locations=locations_nb,
+                rows_per_s=round(rows / metrics["duration_s"], 1),
+                api_calls=api.api_calls_nb,
+                cache_hit_rate=round(get_hit_rate(cache), 3),
+                **metrics
+            )]
+
+
+def print_results(results):
+    columns = ["scenario", "cache", "rows", "locations", "rows_per_s", "api_calls", "http_requests",
+               "throttled_requests", "cache_hit_rate", "duration_s", "peak_memory_mb"]
+    print(pd.DataFrame(results, columns=columns).to_string(index=False))
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the OpenWeatherMap plugin")
+    parser.add_argument("--rows", type=parse_int_list, default=[1000, 10000], help="Recipe input sizes")
+    parser.add_argument("--locations", type=parse_int_list, default=[10, 100], help="Distinct locations")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Latency of the stub API")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--payloads-dir", help="Directory of recorded onecall.json and timemachine.json payloads")
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--calls-per-minute", type=int, default=0)
+    parser.add_argument("--memory-cache-entries", type=int, default=1000)
+    parser.add_argument("--output", help="Path of a JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = []
+    with StubOpenWeatherMapServer(latency=args.latency_ms / 1000, error_rate=args.error_rate,
+                                  payloads_dir=args.payloads_dir) as stub:
+        for locations_nb in args.locations:
+            for rows_nb in args.rows:
+                results += run_recipe_scenario(stub, args, rows_nb, locations_nb)
+            for granularity in ["hourly", "daily"]:
+                results += run_connector_scenario(stub, args, locations_nb, granularity)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+TIMESTAMP_KEYS = {"dt", "sunrise", "sunset", "moonrise", "moonset"}
+WEATHER_CONDITIONS = [
+    {"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"},
+    {"id": 500, "main": "Rain", "description": "light rain", "icon": "10d"},
+]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def shift_timestamps(payload, delta):
+    """
+    Shifts every timestamp of a recorded payload by delta seconds
+    """
+    if isinstance(payload, dict):
+        return {
+            k: v + delta if k in TIMESTAMP_KEYS and isinstance(v, int) else shift_timestamps(v, delta)
+            for k, v in payload.items()
+        }
+    if isinstance(payload, list):
+        return [shift_timestamps(e, delta) for e in payload]
+    return payload
+
+
+def synthetic_item(dt, daily=False):
+    item = {
+        "dt": dt,
+        "pressure": 1013,
+        "humidity": 60,
+        "dew_point": 280.5,
+        "clouds": 20,
+        "visibility": 10000,
+        "wind_speed": 3.6,
+        "wind_deg": 220,
+        "weather": [random.choice(WEATHER_CONDITIONS)]
+    }
+    if daily:
+        item.update(
+            sunrise=dt - 6 * 3600,
+            sunset=dt + 6 * 3600,
+            temp={k: 285.0 for k in ["day", "min", "max", "night", "eve", "morn"]},
+            feels_like={k: 284.0 for k in ["day", "night", "eve", "morn"]},
+            uvi=2.5
+        )
+    else:
+        item.update(temp=285.0, feels_like=284.0)
+    return item
+
+
+def synthetic_timemachine(lat, lon, dt):
+    day = dt - dt % 86400
+    current = dict(synthetic_item(dt), sunrise=day + 6 * 3600, sunset=day + 18 * 3600, uvi=2.5)
+    return {
+        "lat": lat, "lon": lon, "timezone": "UTC", "timezone_offset": 0,
+        "current": current,
+        "hourly": [synthetic_item(day + hour * 3600) for hour in range(24)]
+    }
+
+
+def synthetic_onecall(lat, lon, now):
+    hour = now - now % 3600
+    day = now - now % 86400
+    return {
+        "lat": lat, "lon": lon, "timezone": "UTC", "timezone_offset": 0,
+        "current": synthetic_item(now),
+        "minutely": [{"dt": now + 60 * minute, "precipitation": 0} for minute in range(61)],
+        "hourly": [synthetic_item(hour + hours * 3600) for hours in range(48)],
+        "daily": [synthetic_item(day + days * 86400 + 12 * 3600, daily=True) for days in range(8)]
+    }
+
+
+class StubOpenWeatherMapServer:
+    """
+    Local stand-in for the onecall and onecall/timemachine endpoints of OpenWeatherMap API.
+    Serves synthetic payloads, or recorded ones (onecall.json and timemachine.json in payloads_dir) whose
+    timestamps are shifted to the requested date. Every response is delayed by latency seconds, and a share
+    error_rate of the requests is answered with a 429 and a Retry-After header.
+    Point OpenWeatherMapAPI.base_url at base_url to use it.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=0.1, payloads_dir=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.recorded_payloads = {}
+        if payloads_dir:
+            for endpoint in ["onecall", "timemachine"]:
+                path = os.path.join(payloads_dir, f"{endpoint}.json")
+                if os.path.exists(path):
+                    with open(path) as f:
+                        self.recorded_payloads[endpoint] = json.load(f)
+        self.requests_nb = 0
+        self.throttled_nb = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._build_handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}/data/2.5/".format(self._server.server_port)
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests_nb = 0
+            self.throttled_nb = 0
+
+    def get_payload(self, endpoint, params):
+        lat, lon = float(params.get("lat", 0)), float(params.get("lon", 0))
+        now = int(time.time())
+        if endpoint.endswith("timemachine"):
+            dt = int(params.get("dt", now))
+            recorded = self.recorded_payloads.get("timemachine")
+            if recorded:
+                return shift_timestamps(recorded, dt - recorded["current"]["dt"])
+            return synthetic_timemachine(lat, lon, dt)
+        recorded = self.recorded_payloads.get("onecall")
+        if recorded:
+            payload = shift_timestamps(recorded, now - recorded["current"]["dt"])
+        else:
+            payload = synthetic_onecall(lat, lon, now)
+        excluded_parts = params.get("exclude", "").split(",")
+        return {k: v for k, v in payload.items() if k not in excluded_parts}
+
+    def _build_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stub._lock:
+                    stub.requests_nb += 1
+                    throttled = random.random() < stub.error_rate
+                    stub.throttled_nb += throttled
+                time.sleep(stub.latency)
+                if throttled:
+                    self._send(429, {"cod": 429, "message": "Too many requests"}, {"Retry-After": stub.retry_after})
+                elif url.path.endswith("timemachine") and int(params.get("dt", 0)) < time.time() - 5 * 86400:
+                    self._send(400, {"cod": "400", "message": "requested time is out of allowed range"})
+                elif url.path.rstrip("/").endswith(("onecall", "onecall/timemachine")):
+                    self._send(200, stub.get_payload(url.path.rstrip("/"), params))
+                else:
+                    self._send(404, {"cod": "404", "message": "Internal error"})
+
+            def _send(self, status_code, payload, headers=None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, str(v))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()